@@ -0,0 +1,53 @@
+"""
+Análisis del canal alfa para decidir entre PNG y JPEG.
+
+Todo se calcula con el histograma de Pillow (una pasada en C sobre el
+canal), sin convertir los píxeles a objetos de Python.
+"""
+from collections import namedtuple
+
+# Proporción mínima de píxeles no opacos para considerar transparencia real
+TRANSPARENCY_THRESHOLD = 0.01
+
+AlphaStats = namedtuple('AlphaStats', ['transparent_ratio', 'opaque_bbox', 'fully_opaque'])
+AlphaStats.__doc__ = """
+transparent_ratio: proporción de píxeles con alfa < 255
+opaque_bbox: caja (izq, arriba, der, abajo) de los píxeles no totalmente transparentes, o None
+fully_opaque: True si todos los píxeles tienen alfa 255
+"""
+
+def get_alpha_channel(img):
+    """Canal alfa de la imagen, o None si no tiene transparencia"""
+    if img.mode in ('RGBA', 'LA', 'PA'):
+        return img.getchannel('A')
+    if 'transparency' in img.info:
+        return img.convert('RGBA').getchannel('A')
+    return None
+
+def analyze_alpha(img):
+    """Proporción de píxeles transparentes, caja opaca y si la imagen es totalmente opaca"""
+    total_pixels = img.width * img.height
+    full_bbox = (0, 0, img.width, img.height) if total_pixels else None
+
+    alpha = get_alpha_channel(img)
+    if alpha is None or total_pixels == 0:
+        return AlphaStats(0.0, full_bbox, True)
+
+    histogram = alpha.histogram()
+    opaque_pixels = histogram[255]
+    transparent_ratio = (total_pixels - opaque_pixels) / total_pixels
+
+    if opaque_pixels == total_pixels:
+        return AlphaStats(0.0, full_bbox, True)
+    if histogram[0] == total_pixels:
+        return AlphaStats(1.0, None, False)
+
+    return AlphaStats(transparent_ratio, alpha.getbbox(), False)
+
+def has_real_transparency(img, threshold=TRANSPARENCY_THRESHOLD):
+    """
+    True si la transparencia es un recorte real y no unos pocos píxeles
+    semitransparentes sueltos (en ese caso conviene JPEG).
+    """
+    stats = analyze_alpha(img)
+    return not stats.fully_opaque and stats.transparent_ratio > threshold
@@ -1,86 +1,417 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
 import os
 import zipfile
 import shutil
-from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 import uuid
 from datetime import datetime, timedelta
 import json
+import hashlib
 from PIL import Image
 import io
 import subprocess
+from urllib.parse import quote
 import threading
 import time
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from alpha_analysis import has_real_transparency
+import zip_stream
+from zip_stream import iter_zip_stream, plan_zip_entries
+from multipart_upload import receive_multipart_files
+from result_cache import ResultCache
+from thumbnail_cache import ThumbnailCache
+from session_store import SessionStore
+from session_expiry import SessionExpiryScheduler
+from storage_governor import StorageGovernor
+from capabilities import CapabilityProbe, command_version, pillow_info, rembg_models
 
 try:
     from rembg import remove, new_session
+    import numpy as np
     REMBG_AVAILABLE = True
 except ImportError:
     REMBG_AVAILABLE = False
 
+try:
+    import oxipng as pyoxipng
+except ImportError:
+    pyoxipng = None
+
 app = Flask(__name__)
 CORS(app)
 
 UPLOAD_FOLDER = 'uploads'
 MAX_CONTENT_LENGTH = 500 * 1024 * 1024  
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
 ALLOWED_EXTENSIONS = {
     'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 
     'tiff', 'tif', 'raw', 'heic', 'psd',  'zip'
 }
 
+# Límites de los ZIP subidos, comprobados en la cabecera antes de extraer
+MAX_ZIP_MEMBERS = int(os.environ.get('MAX_ZIP_MEMBERS', 10000))
+MAX_ZIP_UNCOMPRESSED_BYTES = int(os.environ.get('MAX_ZIP_UNCOMPRESSED_BYTES', 4 * 1024 * 1024 * 1024))
+MAX_ZIP_COMPRESSION_RATIO = int(os.environ.get('MAX_ZIP_COMPRESSION_RATIO', 200))
+# Hilos que escriben a la vez las imágenes de un ZIP
+ZIP_INGEST_WORKERS = int(os.environ.get('ZIP_INGEST_WORKERS', 4))
+
+# Rango de calidades JPEG al reducir peso de imágenes sin transparencia
+JPEG_QUALITY_MIN = 70
+JPEG_QUALITY_MAX = 90
+
+# Entrega de descargas individuales:
+#   'sendfile'   -> send_file de Flask (wsgi.file_wrapper / sendfile del servidor)
+#   'x-accel'    -> cabecera X-Accel-Redirect para que nginx envíe el archivo
+#   'x-sendfile' -> cabecera X-Sendfile (Apache mod_xsendfile, lighttpd)
+DOWNLOAD_SERVE_MODE = os.environ.get('DOWNLOAD_SERVE_MODE', 'sendfile')
+# Location interna de nginx que apunta a UPLOAD_FOLDER
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/protected-uploads/')
+# Margen para que el servidor web termine de enviar antes de limpiar la sesión (segundos)
+OFFLOAD_CLEANUP_DELAY = int(os.environ.get('OFFLOAD_CLEANUP_DELAY', 300))
+
+# Base de datos SQLite con las sesiones, sus archivos y resultados
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', 'sessions.db')
+
+# Tiempo que se conserva una sesión sin descargar desde su última actividad (segundos)
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 2 * 3600))
+# Papelera de sesiones caducadas pendientes de borrar, dentro de UPLOAD_FOLDER
+TRASH_FOLDER = os.path.join(UPLOAD_FOLDER, '.trash')
+
+# Ocupación del disco (fracción) a partir de la cual se eliminan sesiones
+# antiguas para hacer sitio, y hasta dónde se intenta bajar
+STORAGE_HIGH_WATERMARK = float(os.environ.get('STORAGE_HIGH_WATERMARK', 0.90))
+STORAGE_LOW_WATERMARK = float(os.environ.get('STORAGE_LOW_WATERMARK', 0.80))
+# Retry-After de las subidas rechazadas mientras hay sesiones en uso (segundos)
+STORAGE_RETRY_AFTER = int(os.environ.get('STORAGE_RETRY_AFTER', 30))
+# Margen durante el que una sesión subida y aún sin procesar no se elimina por espacio (segundos)
+STORAGE_UNPROCESSED_GRACE = int(os.environ.get('STORAGE_UNPROCESSED_GRACE', 600))
+
+# Tiempo que se conserva la sesión tras una descarga incompleta, para poder reanudarla (segundos)
+DOWNLOAD_GRACE_TTL = int(os.environ.get('DOWNLOAD_GRACE_TTL', 600))
+# Cada cuánto renueva ese plazo un ZIP que se está enviando (segundos)
+DOWNLOAD_RENEW_INTERVAL = 60
+
+# Caché de resultados por contenido y opciones (RESULT_CACHE_ENABLED=0 para desactivarla)
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', '1') == '1'
+RESULT_CACHE_FOLDER = os.environ.get('RESULT_CACHE_FOLDER', 'cache')
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+# Versión del pipeline de procesamiento: cambiarla invalida los resultados en caché
+PIPELINE_VERSION = 2
+
+# Margen de las reducciones en dos pasos: JPEG se decodifica a escala
+# reducida (draft) y el resto se reduce con reduce(), sin bajar de
+# REDUCING_GAP veces el tamaño final; LANCZOS hace el último paso
+REDUCING_GAP = 2.0
+
+# Vistas previas: tamaño por defecto y límites de ?size= (px)
+PREVIEW_SIZE = 300
+PREVIEW_MIN_SIZE = 16
+PREVIEW_MAX_SIZE = 1024
+# Tamaño de la miniatura enlazada en cada resultado de /api/process
+RESULT_PREVIEW_SIZE = 150
+# Caché de miniaturas en memoria y tiempo que el navegador puede reutilizarlas (segundos)
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+PREVIEW_MAX_AGE = int(os.environ.get('PREVIEW_MAX_AGE', 300))
+# Tras un fallo del índice, las carpetas de sesión se vuelven a recorrer como mucho
+# una vez en este intervalo (segundos); el resto de fallos responde 404 sin tocar disco
+PREVIEW_RESCAN_INTERVAL = int(os.environ.get('PREVIEW_RESCAN_INTERVAL', 10))
+# Versión del formato de las miniaturas: cambiarla invalida las guardadas
+THUMBNAIL_VERSION = 1
+
+# Número de procesos para /api/process (1 = procesamiento secuencial)
+PROCESS_WORKERS = int(os.environ.get('PROCESS_WORKERS', os.cpu_count() or 1))
+# Los workers se crean con 'spawn': el pool se inicia desde hilos (precarga,
+# peticiones) y un fork podría heredar bloqueos tomados por otro hilo
+PROCESS_CONTEXT = multiprocessing.get_context('spawn')
+
+# Trabajos asíncronos de /api/process que se ejecutan a la vez
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_TTL = timedelta(hours=2)
+
+# Intervalo de keep-alive del stream de eventos de procesamiento (segundos)
+SSE_KEEPALIVE_SECONDS = 15
+
+# Cada cuánto se vuelven a comprobar herramientas, modelos y códecs (segundos)
+CAPABILITY_REFRESH_SECONDS = int(os.environ.get('CAPABILITY_REFRESH_SECONDS', 600))
+# /readyz responde 503 con más lotes esperando worker o más trabajos en cola que esto
+READY_MAX_QUEUED_BATCHES = int(os.environ.get('READY_MAX_QUEUED_BATCHES', PROCESS_WORKERS * 4))
+READY_MAX_QUEUED_JOBS = int(os.environ.get('READY_MAX_QUEUED_JOBS', JOB_WORKERS * 4))
+
+# Modelo rembg y precarga de sesiones al arrancar
+REMBG_MODEL = os.environ.get('REMBG_MODEL', 'u2net')
+REMBG_PREWARM = os.environ.get('REMBG_PREWARM', '1') == '1'
+
+# Hilos de onnxruntime por worker del pool: sin límite cada worker usaría
+# todos los núcleos y con PROCESS_WORKERS workers competirían entre sí
+REMBG_THREADS_PER_WORKER = int(os.environ.get('REMBG_THREADS_PER_WORKER',
+                                              max(1, (os.cpu_count() or 1) // max(PROCESS_WORKERS, 1))))
+
+# Imágenes por pasada del modelo al eliminar fondo (1 = sin lotes)
+REMBG_BATCH_SIZE = int(os.environ.get('REMBG_BATCH_SIZE', 4))
+
+# Entrada de los modelos que admiten inferencia en lote: (mean, std, tamaño)
+REMBG_BATCH_INPUTS = {
+    'u2net': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'u2netp': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'u2net_human_seg': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'silueta': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'isnet-general-use': ((0.485, 0.456, 0.406), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# ALMACÉN DE SESIONES
+session_store = SessionStore(SESSION_DB_PATH)
+
+def load_session(session_id):
+    """
+    Datos de una sesión, o None si no existe. Las sesiones creadas antes del
+    almacén SQLite se importan desde su metadata.json la primera vez.
+    """
+    session = session_store.get_session(session_id)
+    if session is not None:
+        storage_governor.touch(os.path.join(UPLOAD_FOLDER, session_id))
+        return session
+    
+    metadata_path = os.path.join(UPLOAD_FOLDER, session_id, 'metadata.json')
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, 'r', encoding='utf-8') as f:
+        session_store.import_metadata(json.load(f))
+    os.remove(metadata_path)
+    return session_store.get_session(session_id)
+
+# ÍNDICE DE VISTAS PREVIAS
+# nombre de archivo -> ruta, y archivos indexados de cada sesión para quitarlos al limpiarla
+_preview_index = {}
+_preview_sessions = {}
+_preview_index_lock = threading.Lock()
+_preview_rescanned_at = None
+
+def index_preview_files(session_folder, paths):
+    """Registrar archivos de una sesión para /api/preview"""
+    with _preview_index_lock:
+        names = _preview_sessions.setdefault(session_folder, set())
+        for path in paths:
+            filename = os.path.basename(path)
+            _preview_index[filename] = path
+            names.add(filename)
+
+def unindex_preview_session(session_folder):
+    """Quitar del índice los archivos de una sesión"""
+    with _preview_index_lock:
+        for filename in _preview_sessions.pop(session_folder, ()):
+            if os.path.dirname(_preview_index.get(filename, '')) == session_folder:
+                del _preview_index[filename]
+
+def remove_session_folder(session_folder):
+    """
+    Quitar una sesión: sus datos, sus entradas del índice de vistas previas y
+    su carpeta, que pasa a la papelera y se borra en segundo plano.
+    Devuelve False si la carpeta ya no existía.
+    """
+    unindex_preview_session(session_folder)
+    session_store.delete_session(os.path.basename(session_folder))
+    session_expiry.cancel(session_folder)
+    return session_expiry.trash(session_folder, storage_governor.forget(session_folder))
+
 # SISTEMA DE LIMPIEZA 
+def expire_session(session_folder):
+    if remove_session_folder(session_folder):
+        print(f"✓ Sesión limpiada automáticamente: {os.path.basename(session_folder)}")
+
+# Un solo hilo atiende todas las caducidades; reprogramar una sesión reemplaza su plazo
+session_expiry = SessionExpiryScheduler(TRASH_FOLDER, expire_session)
+
+# Con el disco por encima de la marca alta se eliminan las sesiones usadas hace más tiempo
+storage_governor = StorageGovernor(UPLOAD_FOLDER, STORAGE_HIGH_WATERMARK, STORAGE_LOW_WATERMARK,
+                                   evict=remove_session_folder,
+                                   pending_bytes=lambda: session_expiry.trash_bytes,
+                                   unprocessed_grace=STORAGE_UNPROCESSED_GRACE)
+
 def schedule_session_cleanup(session_folder, delay=3):
     """
     Programa limpieza de sesión después de un delay.
-    Ideal para limpiar después de descarga.
+    Ideal para limpiar después de descarga. Si se vuelve a programar la
+    misma sesión (p. ej. al reanudar una descarga), manda la última llamada.
     """
-    def cleanup():
-        time.sleep(delay)
-        try:
-            if os.path.exists(session_folder):
-                shutil.rmtree(session_folder)
-                print(f"✓ Sesión limpiada automáticamente: {os.path.basename(session_folder)}")
-        except Exception as e:
-            print(f"✗ Error limpiando sesión: {str(e)}")
+    session_expiry.schedule(session_folder, delay)
+
+def schedule_existing_sessions():
+    """
+    Al arrancar, programar la caducidad de las sesiones que ya había en
+    disco (SESSION_TTL desde el último cambio de su carpeta), registrar su
+    tamaño y olvidar los datos de las sesiones cuya carpeta ya no existe.
+    """
+    now = time.time()
+    existing = []
+    for entry in os.scandir(UPLOAD_FOLDER):
+        if entry.name.startswith('.') or not entry.is_dir():
+            continue
+        stat = entry.stat()
+        schedule_session_cleanup(entry.path, delay=max(stat.st_ctime + SESSION_TTL - now, 0))
+        storage_governor.track(entry.path, last_used=stat.st_mtime)
+        existing.append(entry.name)
     
-    threading.Thread(target=cleanup, daemon=True).start()
+    scheduled = len(existing)
+    purged = session_store.delete_sessions_except(existing)
+    if scheduled or purged:
+        print(f"🧹 Caducidad programada para {scheduled} sesiones existentes ({purged} registros sin carpeta eliminados)")
 
-def cleanup_old_sessions():
+# SESIONES REMBG
+_rembg_session = None
+_rembg_session_lock = threading.Lock()
+_rembg_session_error = None
+
+# Workers del pool con el modelo ya cargado (compartido entre procesos)
+_warm_workers = PROCESS_CONTEXT.Value('i', 0)
+# Último error de carga del modelo en un worker, visible desde el proceso principal
+_worker_load_error = PROCESS_CONTEXT.Array('c', 512)
+
+def get_rembg_session():
     """
-    Limpieza de respaldo para sesiones abandonadas (más de 2 horas).
-    Se ejecuta periódicamente como backup.
+    Sesión rembg del proceso actual.
+    Se crea una sola vez y se reutiliza para todas las imágenes.
     """
-    while True:
+    global _rembg_session, _rembg_session_error
+    if _rembg_session is not None:
+        return _rembg_session
+    
+    with _rembg_session_lock:
+        if _rembg_session is None:
+            started = time.time()
+            try:
+                _rembg_session = new_session(REMBG_MODEL)
+                _rembg_session_error = None
+            except Exception as e:
+                _rembg_session_error = str(e)
+                raise
+            print(f"✓ Modelo rembg '{REMBG_MODEL}' cargado en {time.time() - started:.1f}s (pid {os.getpid()})")
+    
+    return _rembg_session
+
+def warm_rembg_session():
+    """Cargar el modelo rembg si está disponible, sin propagar errores"""
+    if not REMBG_AVAILABLE:
+        return False
+    try:
+        get_rembg_session()
+        return True
+    except Exception as e:
+        print(f"✗ Error precargando rembg: {str(e)}")
+        return False
+
+def init_process_worker(warm_workers, load_error):
+    """
+    Inicializador de cada worker del pool.
+    Cada worker carga su propia sesión rembg; si falla, el error queda en
+    `load_error` para que el proceso principal lo vea. rembg toma de
+    OMP_NUM_THREADS los hilos de onnxruntime de la sesión, así que se fija
+    antes de crearla para repartir los núcleos entre los workers.
+    """
+    global _rembg_session, _rembg_session_lock, _warm_workers
+    os.environ['OMP_NUM_THREADS'] = str(REMBG_THREADS_PER_WORKER)
+    _rembg_session = None
+    _rembg_session_lock = threading.Lock()
+    _warm_workers = warm_workers
+    
+    if not REMBG_PREWARM:
+        return
+    if warm_rembg_session():
+        with warm_workers.get_lock():
+            warm_workers.value += 1
+    elif _rembg_session_error:
+        load_error.value = _rembg_session_error.encode('utf-8', 'replace')[:len(load_error) - 1]
+
+_rembg_batch_supported = True
+
+def predict_masks_batch(image_infos):
+    """
+    Máscaras de eliminación de fondo de varias imágenes con una sola pasada
+    del modelo. Cada imagen se decodifica reducida (el modelo solo la ve a
+    su tamaño de entrada) y la máscara se devuelve a ese tamaño, que pesa
+    poco al volver del worker; process_single_image la escala a su imagen.
+    Devuelve una máscara por imagen, o None para las que hay que procesar solas.
+    """
+    global _rembg_batch_supported
+    masks = [None] * len(image_infos)
+    if not REMBG_AVAILABLE or not _rembg_batch_supported or REMBG_MODEL not in REMBG_BATCH_INPUTS:
+        return masks
+    
+    mean, std, size = REMBG_BATCH_INPUTS[REMBG_MODEL]
+    try:
+        session = get_rembg_session()
+        positions = []
+        inputs = []
+        for position, image_info in enumerate(image_infos):
+            try:
+                with Image.open(image_info['path']) as img:
+                    small = make_thumbnail(img, int(max(size) * REDUCING_GAP)).convert('RGB')
+            except Exception:
+                continue  # process_single_image vuelve a intentarlo y reporta el error
+            positions.append(position)
+            inputs.append(session.normalize(small, mean, std, size))
+        
+        if len(inputs) < 2:
+            return masks
+        
+        input_name = next(iter(inputs[0]))
+        batch = np.concatenate([model_input[input_name] for model_input in inputs], axis=0)
+        
         try:
-            current_time = datetime.now()
-            cleaned = 0
-            for session_dir in os.listdir(UPLOAD_FOLDER):
-                session_path = os.path.join(UPLOAD_FOLDER, session_dir)
-                if os.path.isdir(session_path):
-                    dir_time = datetime.fromtimestamp(os.path.getctime(session_path))
-                    if current_time - dir_time > timedelta(hours=2):
-                        shutil.rmtree(session_path)
-                        cleaned += 1
-            
-            if cleaned > 0:
-                print(f"🧹 Limpieza de respaldo: {cleaned} sesiones antiguas eliminadas")
-                
+            predictions = session.inner_session.run(None, {input_name: batch})[0]
         except Exception as e:
-            print(f"Error en limpieza de respaldo: {str(e)}")
+            # Modelo exportado con tamaño de lote fijo: seguir imagen por imagen
+            print(f"Inferencia en lote no soportada por '{REMBG_MODEL}': {str(e)}")
+            _rembg_batch_supported = False
+            return masks
         
-        time.sleep(3600)
+        for position, prediction in zip(positions, predictions[:, 0, :, :]):
+            low, high = prediction.min(), prediction.max()
+            prediction = (prediction - low) / (high - low) if high > low else np.zeros_like(prediction)
+            masks[position] = Image.fromarray((prediction * 255).astype('uint8'), mode='L')
+    except Exception as e:
+        print(f"✗ Error en lote de eliminación de fondo, procesando una por una: {str(e)}")
+        return [None] * len(image_infos)
+    
+    print(f"REMOVE_BG: Lote de {len(positions)} imágenes procesado")
+    return masks
 
-cleanup_thread = threading.Thread(target=cleanup_old_sessions, daemon=True)
-cleanup_thread.start()
+def get_rembg_status():
+    """Estado de las sesiones rembg para /api/health"""
+    if PROCESS_WORKERS > 1:
+        ready = _warm_workers.value > 0
+        error = _worker_load_error.value.decode('utf-8', 'replace') or None
+    else:
+        ready = _rembg_session is not None
+        error = _rembg_session_error
+    
+    return {
+        'model': REMBG_MODEL,
+        'ready': REMBG_AVAILABLE and ready,
+        'batch_size': REMBG_BATCH_SIZE,
+        'warm_workers': _warm_workers.value,
+        'threads_per_worker': REMBG_THREADS_PER_WORKER if PROCESS_WORKERS > 1 else None,
+        'error': error
+    }
 
 # FUNCIONES AUXILIARES
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def file_sha256(path):
+    """Hash SHA-256 del contenido de un archivo, leído por bloques"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(zip_stream.CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def is_image_file(filename):
     image_extensions = {
         'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 
@@ -88,45 +419,123 @@ def is_image_file(filename):
     }
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in image_extensions
 
-def extract_images_from_zip(zip_path, extract_to):
-    """Extraer imágenes de archivo ZIP"""
-    extracted_images = []
+def check_zip_limits(zip_ref):
+    """
+    Comprobar con la cabecera del ZIP los límites de entradas, tamaño
+    descomprimido y ratio de compresión, antes de escribir nada.
+    Devuelve las entradas de imagen; lanza ValueError si el ZIP no es aceptable.
+    """
+    members = zip_ref.infolist()
+    if len(members) > MAX_ZIP_MEMBERS:
+        raise ValueError(f"demasiadas entradas ({len(members)}, máximo {MAX_ZIP_MEMBERS})")
     
+    image_members = [m for m in members if not m.is_dir() and is_image_file(m.filename)]
+    
+    total_size = sum(m.file_size for m in image_members)
+    if total_size > MAX_ZIP_UNCOMPRESSED_BYTES:
+        raise ValueError(f"tamaño descomprimido excesivo ({total_size // (1024 * 1024)}MB, "
+                         f"máximo {MAX_ZIP_UNCOMPRESSED_BYTES // (1024 * 1024)}MB)")
+    
+    for member in image_members:
+        if member.file_size > max(member.compress_size, 1) * MAX_ZIP_COMPRESSION_RATIO:
+            raise ValueError(f"ratio de compresión sospechoso en {member.filename}")
+    
+    return image_members
+
+def write_zip_member(zip_ref, file_info, extract_to):
+    """Escribir una entrada del ZIP directamente en su ruta final de la sesión"""
+    original_name = os.path.basename(file_info.filename)
+    unique_name = f"{uuid.uuid4()}_{original_name}"
+    new_path = os.path.join(extract_to, unique_name)
+    
+    try:
+        digest = hashlib.sha256()
+        with zip_ref.open(file_info) as source, open(new_path, 'wb') as dest:
+            for chunk in iter(lambda: source.read(zip_stream.CHUNK_SIZE), b''):
+                digest.update(chunk)
+                dest.write(chunk)
+            size = dest.tell()
+    except Exception as e:
+        print(f"Error extrayendo {file_info.filename}: {str(e)}")
+        if os.path.exists(new_path):
+            os.remove(new_path)
+        return None
+    
+    return {
+        'filename': unique_name,
+        'original_name': original_name,
+        'path': new_path,
+        'size': size,
+        'sha256': digest.hexdigest()
+    }
+
+def ensure_zip_space(zip_path):
+    """
+    Hacer sitio para las imágenes de un ZIP subido antes de extraerlas (su
+    tamaño descomprimido, que check_zip_limits limita a MAX_ZIP_UNCOMPRESSED_BYTES).
+    Devuelve lo mismo que StorageGovernor.ensure_space; los ZIP no válidos
+    los reporta extract_images_from_zip.
+    """
     try:
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            for file_info in zip_ref.filelist:
-                if not file_info.is_dir() and is_image_file(file_info.filename):
-                    try:
-                        zip_ref.extract(file_info, extract_to)
-                        
-                        original_name = os.path.basename(file_info.filename)
-                        unique_name = f"{uuid.uuid4()}_{original_name}"
-                        
-                        old_path = os.path.join(extract_to, file_info.filename)
-                        new_path = os.path.join(extract_to, unique_name)
-                        
-                        if os.path.dirname(file_info.filename):
-                            os.makedirs(os.path.dirname(new_path), exist_ok=True)
-                        
-                        if os.path.exists(old_path):
-                            shutil.move(old_path, new_path)
-                            extracted_images.append({
-                                'filename': unique_name,
-                                'original_name': original_name,
-                                'path': new_path,
-                                'size': os.path.getsize(new_path)
-                            })
-                    except Exception as e:
-                        print(f"Error extrayendo {file_info.filename}: {str(e)}")
-                        continue
+            image_members = check_zip_limits(zip_ref)
+    except (zipfile.BadZipFile, ValueError, OSError):
+        return None
+    return storage_governor.ensure_space(sum(member.file_size for member in image_members))
+
+def extract_images_from_zip(zip_path, extract_to):
+    """
+    Extraer imágenes de archivo ZIP.
+    Cada entrada se descomprime en streaming a su nombre final (una sola
+    escritura, sin carpetas intermedias), con ZIP_INGEST_WORKERS hilos.
+    """
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            image_members = check_zip_limits(zip_ref)
+            
+            workers = max(1, min(ZIP_INGEST_WORKERS, len(image_members)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                extracted = executor.map(lambda info: write_zip_member(zip_ref, info, extract_to), image_members)
+                extracted_images = [img for img in extracted if img]
                         
     except Exception as e:
         return [], str(e)
     
     return extracted_images, None
 
+def detect_png_optimizer():
+    """
+    Elegir una sola vez el optimizador PNG: binding de oxipng en proceso,
+    CLI de oxipng como respaldo, o None (solo la compresión de Pillow).
+    """
+    if pyoxipng is not None and hasattr(pyoxipng, 'optimize_from_memory'):
+        return 'oxipng-python'
+    
+    try:
+        result = subprocess.run(['oxipng', '--version'],
+                              capture_output=True, text=True, timeout=5)
+        if result.returncode == 0:
+            return 'oxipng-cli'
+    except Exception:
+        pass
+    
+    return None
+
+PNG_OPTIMIZER = detect_png_optimizer()
+
+def optimize_png_bytes(data):
+    """Optimizar un PNG en memoria con el binding de oxipng"""
+    try:
+        strip_chunks = getattr(pyoxipng, 'StripChunks', None)
+        kwargs = {'strip': strip_chunks.safe()} if strip_chunks else {}
+        optimized = pyoxipng.optimize_from_memory(data, level=6, **kwargs)
+        return optimized if len(optimized) < len(data) else data
+    except Exception as e:
+        print(f"Error optimizando PNG en memoria: {str(e)}")
+        return data
+
 def optimize_with_oxipng(image_path):
-    """Optimizar PNG usando oxipng"""
+    """Optimizar PNG usando el CLI de oxipng"""
     try:
         result = subprocess.run(['oxipng', '-o', '6', '--strip', 'safe', image_path], 
                               capture_output=True, text=True, timeout=30)
@@ -139,234 +548,329 @@ def optimize_with_oxipng(image_path):
     except Exception as e:
         return False, f"Error ejecutando oxipng: {str(e)}"
 
-def force_size_reduction_safe(image_path, original_dimensions, target_reduction_percent=10):
-    """Reducir peso SIN cambiar dimensiones - GARANTIZADO"""
-    try:
-        original_size = os.path.getsize(image_path)
-        target_size = original_size * (1 - target_reduction_percent / 100)
+def encode_jpeg_for_target(img, target_size, min_quality=JPEG_QUALITY_MIN, max_quality=JPEG_QUALITY_MAX):
+    """
+    Codificar JPEG en memoria con la calidad más alta que quede bajo `target_size`.
+    Búsqueda binaria sobre la calidad; si ninguna alcanza el objetivo se usa la mínima.
+    Devuelve (bytes, calidad).
+    """
+    encoded = {}
+    
+    def encode(quality):
+        if quality not in encoded:
+            buffer = io.BytesIO()
+            img.save(buffer, 'JPEG', quality=quality, optimize=True)
+            encoded[quality] = buffer.getvalue()
+        return encoded[quality]
+    
+    if len(encode(max_quality)) < target_size:
+        return encoded[max_quality], max_quality
+    
+    best_quality = None
+    low, high = min_quality, max_quality - 1
+    while low <= high:
+        quality = (low + high) // 2
+        if len(encode(quality)) < target_size:
+            best_quality = quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    
+    if best_quality is None:
+        best_quality = min_quality
+    return encode(best_quality), best_quality
+
+# PIPELINE EN MEMORIA
+class ImagePipeline:
+    """
+    Pipeline de una imagen en memoria.
+    Decodifica el original una sola vez, aplica las etapas sobre el mismo
+    objeto PIL y codifica una sola vez al guardar. `size` guarda las
+    dimensiones garantizadas de la salida.
+    """
+    
+    def __init__(self, image_path, draft_size=None):
+        """
+        `draft_size` (ancho, alto) indica que la salida será de ese tamaño: un
+        JPEG más grande se decodifica directamente a escala reducida.
+        """
+        self.source_path = image_path
+        self.source_size = os.path.getsize(image_path)
         
         with Image.open(image_path) as img:
-            current_dimensions = img.size
-            
-            if current_dimensions != original_dimensions:
-                print(f"CORRIGIENDO dimensiones: {current_dimensions} -> {original_dimensions}")
-                img = img.resize(original_dimensions, Image.Resampling.LANCZOS)
-            
-            has_transparency = False
-            if img.mode in ('RGBA', 'LA'):
-                if img.mode == 'RGBA':
-                    try:
-                        alpha = img.getchannel('A')
-                        alpha_min, alpha_max = alpha.getextrema()
-                        has_transparency = alpha_min < 255
-                    except:
-                        has_transparency = True
-                else:
-                    has_transparency = True
-            
-            if has_transparency:
-                img.save(image_path, 'PNG', optimize=True, compress_level=9, pnginfo=None)
+            self.original_dimensions = img.size
+            if draft_size:
+                img.draft(img.mode, (int(draft_size[0] * REDUCING_GAP), int(draft_size[1] * REDUCING_GAP)))
+            img.load()
+            self.image = img
+        
+        self.size = self.image.size
+        self.target_reduction_percent = None
+        self.output_format = None
+        self.background_removed = False
+    
+    def _fit_size(self):
+        """Garantizar que la imagen tenga exactamente `size`"""
+        if self.image.size != self.size:
+            print(f"CORRIGIENDO dimensiones: {self.image.size} -> {self.size}")
+            self.image = self.image.resize(self.size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+    
+    def _to_rgba(self):
+        if self.image.mode != 'RGBA':
+            self.image = self.image.convert('RGBA')
+    
+    def rembg_input(self):
+        """Imagen lista para rembg (RGB o RGBA)"""
+        print(f"REMOVE_BG: Dimensiones ORIGINALES: {self.size}")
+        if self.image.mode not in ('RGB', 'RGBA'):
+            self._to_rgba()
+        return self.image
+    
+    def apply_cutout(self, cutout):
+        """Usar el resultado de rembg manteniendo dimensiones originales EXACTAS"""
+        print(f"REMOVE_BG: Después de rembg: {cutout.size}")
+        self.image = cutout
+        self._fit_size()
+        self._to_rgba()
+        self.background_removed = True
+    
+    def apply_mask(self, mask):
+        """Recortar con una máscara de predict_masks_batch, escalada a la imagen"""
+        image = self.rembg_input()
+        mask = mask.resize(image.size, Image.Resampling.LANCZOS)
+        empty = Image.new('RGBA', image.size, 0)
+        self.apply_cutout(Image.composite(image.convert('RGBA'), empty, mask))
+    
+    def remove_background(self, mask=None):
+        """Eliminar fondo, con la máscara ya predicha en un lote si la hay"""
+        if not self.background_removed:
+            if mask is not None:
+                self.apply_mask(mask)
+            elif REMBG_AVAILABLE:
+                # rembg recibe y devuelve imágenes PIL: sin codificar/decodificar PNG intermedios
+                self.apply_cutout(remove(self.rembg_input(), session=get_rembg_session()))
             else:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                base_path = os.path.splitext(image_path)[0]
-                jpg_path = base_path + '.jpg'
-                
-                for quality in [85, 80, 75, 70]:
-                    img.save(jpg_path, 'JPEG', quality=quality, optimize=True)
-                    current_size = os.path.getsize(jpg_path)
-                    if current_size < target_size:
-                        break
-                
-                if os.path.exists(image_path):
-                    os.remove(image_path)
-                os.rename(jpg_path, image_path)
-            
-            with Image.open(image_path) as final_check:
-                final_dimensions = final_check.size
-                if final_dimensions != original_dimensions:
-                    print(f"EMERGENCIA: Dimensiones incorrectas después de reducción!")
-                    corrected = final_check.resize(original_dimensions, Image.Resampling.LANCZOS)
-                    if final_check.mode in ('RGBA', 'LA'):
-                        corrected.save(image_path, 'PNG', optimize=True)
-                    else:
-                        corrected.save(image_path, 'JPEG', quality=80, optimize=True)
-            
-            return True, "Peso reducido manteniendo dimensiones"
-            
-    except Exception as e:
-        return False, f"Error en reducción segura: {str(e)}"
-
-def remove_background(image_path, output_path):
-    """Eliminar fondo manteniendo dimensiones originales EXACTAS"""
-    original_dimensions = None
-    try:
-        with Image.open(image_path) as img:
-            original_dimensions = img.size
-            print(f"REMOVE_BG: Dimensiones ORIGINALES: {original_dimensions}")
-    except Exception as e:
-        return False, f"Error obteniendo dimensiones originales: {str(e)}"
+                self.apply_cutout(self.image)
+        return "Fondo eliminado"
     
-    if not REMBG_AVAILABLE:
-        try:
-            with Image.open(image_path) as img:
-                if img.size != original_dimensions:
-                    img = img.resize(original_dimensions, Image.Resampling.LANCZOS)
-                
-                if img.mode != 'RGBA':
-                    img = img.convert('RGBA')
-                
-                img.save(output_path, 'PNG', optimize=True, compress_level=9)
-                
-                with Image.open(output_path) as check:
-                    if check.size != original_dimensions:
-                        corrected = check.resize(original_dimensions, Image.Resampling.LANCZOS)
-                        corrected.save(output_path, 'PNG', optimize=True)
-                
-                return True, "Fondo eliminado"
-        except Exception as e:
-            return False, f"Error en conversión: {str(e)}"
+    def resize(self, width=None, height=None):
+        """
+        Redimensionar SOLO cuando las dimensiones son diferentes.
+        RGB se redimensiona antes de pasar a RGBA (menos píxeles que convertir).
+        """
+        if self.image.mode not in ('RGB', 'RGBA'):
+            self._to_rgba()
+        
+        message = None
+        if width and height:
+            target_dimensions = (int(width), int(height))
+            if target_dimensions != self.size:
+                original_width, original_height = self.original_dimensions
+                message = f"Redimensionado de {original_width}x{original_height} a {target_dimensions[0]}x{target_dimensions[1]}"
+                print(f"RESIZE: {self.size} -> {target_dimensions[0]}x{target_dimensions[1]}")
+                self.size = target_dimensions
+                self._fit_size()
+        
+        if message is None:
+            print(f"RESIZE: Sin cambios, manteniendo {self.size}")
+        self._to_rgba()
+        return message
     
-    try:
-        with open(image_path, 'rb') as input_file:
-            input_data = input_file.read()
+    def reduce_size(self, target_reduction_percent):
+        """
+        Reducir peso SIN cambiar dimensiones al codificar.
+        Sin transparencia real la salida pasa a JPEG con la calidad más alta
+        que quede por debajo del objetivo (relativo al archivo original).
+        """
+        self.target_reduction_percent = target_reduction_percent
+    
+    def encode(self):
+        """Codificar la imagen una sola vez y devolver los bytes"""
+        self._fit_size()
         
-        output_data = remove(input_data)
+        if self.target_reduction_percent is not None and not has_real_transparency(self.image):
+            if self.image.mode != 'RGB':
+                self.image = self.image.convert('RGB')
+            target_size = self.source_size * (1 - self.target_reduction_percent / 100)
+            data, quality = encode_jpeg_for_target(self.image, target_size)
+            print(f"REDUCE: JPEG quality={quality} ({len(data)//1024}KB, objetivo {int(target_size)//1024}KB)")
+            self.output_format = 'JPEG'
+            return data
+        
+        self._to_rgba()
+        buffer = io.BytesIO()
+        self.image.save(buffer, 'PNG', optimize=True, compress_level=9)
+        self.output_format = 'PNG'
+        return buffer.getvalue()
+    
+    def save(self, output_path, optimize=False):
+        """Escribir la salida a disco (y pasar oxipng si es PNG)"""
+        data = self.encode()
+        optimize = optimize and self.output_format == 'PNG'
+        
+        if optimize and PNG_OPTIMIZER == 'oxipng-python':
+            data = optimize_png_bytes(data)
         
         with open(output_path, 'wb') as output_file:
-            output_file.write(output_data)
+            output_file.write(data)
         
-        with Image.open(output_path) as img:
-            current_dimensions = img.size
-            print(f"REMOVE_BG: Después de rembg: {current_dimensions}")
-            
-            if current_dimensions != original_dimensions:
-                print(f"CORRIGIENDO: {current_dimensions} -> {original_dimensions}")
-                img = img.resize(original_dimensions, Image.Resampling.LANCZOS)
-            
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
-            
-            img.save(output_path, 'PNG', optimize=True, compress_level=9, pnginfo=None)
+        if optimize and PNG_OPTIMIZER == 'oxipng-cli':
+            optimize_with_oxipng(output_path)
+
+def make_thumbnail(img, size):
+    """
+    Copia de `img` reducida para caber en size×size, sin copiar antes la
+    imagen completa. Un JPEG aún sin decodificar se decodifica a 1/2, 1/4
+    o 1/8 de escala (draft); el resto se reduce primero con reduce().
+    """
+    img.draft(None, (int(size * REDUCING_GAP), int(size * REDUCING_GAP)))
+    
+    scale = min(size / img.width, size / img.height)
+    if scale >= 1:
+        return img.copy()
+    
+    target = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(target, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+
+def create_image_preview_data(img):
+    """Crear datos de preview de la imagen en base64"""
+    try:
+        preview = make_thumbnail(img, 150)
         
-        with Image.open(output_path) as final_check:
-            final_dimensions = final_check.size
-            print(f"REMOVE_BG: Dimensiones FINALES: {final_dimensions}")
-            
-            if final_dimensions != original_dimensions:
-                print(f"ÚLTIMA CORRECCIÓN: {final_dimensions} -> {original_dimensions}")
-                corrected = final_check.resize(original_dimensions, Image.Resampling.LANCZOS)
-                corrected.save(output_path, 'PNG', optimize=True)
+        buffer = io.BytesIO()
+        if preview.mode in ('RGBA', 'LA'):
+            preview.save(buffer, format='PNG')
+        else:
+            preview.save(buffer, format='JPEG', quality=70)
         
-        force_size_reduction_safe(output_path, original_dimensions, 15)
-        optimize_with_oxipng(output_path)
+        img_data = buffer.getvalue()
+        import base64
+        b64_data = base64.b64encode(img_data).decode()
         
-        return True, "Fondo eliminado"
-    
-    except Exception as e:
-        return False, f"Error eliminando fondo: {str(e)}"
+        format_type = 'png' if preview.mode in ('RGBA', 'LA') else 'jpeg'
+        return f"data:image/{format_type};base64,{b64_data}"
+    except:
+        return None
+
+def build_preview_url(options, session_folder, filename, content_hash):
+    """
+    URL de la miniatura de un resultado. `v` cambia con el contenido, así
+    que el navegador puede guardarla sin volver a validarla.
+    """
+    session_id = os.path.basename(session_folder)
+    return (f"{options.get('preview_base_url', '')}/api/preview/{session_id}/{quote(filename)}"
+            f"?size={RESULT_PREVIEW_SIZE}&v={content_hash[:16]}")
 
-def resize_image(image_path, output_path, width=None, height=None):
-    """Redimensionar imagen SOLO cuando las dimensiones son diferentes"""
+def pregenerate_thumbnail(final_path, img, image_format):
+    """
+    Dejar en la caché de la sesión la miniatura del resultado, a partir de
+    la imagen que ya está en memoria (evita decodificar el archivo después).
+    """
     try:
-        with Image.open(image_path) as img:
-            original_dimensions = img.size
-            print(f"RESIZE: Dimensiones originales: {original_dimensions}")
-            
-            if img.mode in ('RGBA', 'LA'):
-                pass  
-            elif 'transparency' in img.info:
-                img = img.convert('RGBA')
-            else:
-                img = img.convert('RGBA')
-            
-            if width and height:
-                target_width = int(width)
-                target_height = int(height)
-                
-                if target_width != original_dimensions[0] or target_height != original_dimensions[1]:
-                    img_resized = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-                    message = f"Redimensionado de {original_dimensions[0]}x{original_dimensions[1]} a {target_width}x{target_height}"
-                    print(f"RESIZE: {original_dimensions} -> {target_width}x{target_height}")
-                    
-                    img_resized.save(output_path, 'PNG', optimize=True, compress_level=9, pnginfo=None)
-                    
-                    with Image.open(output_path) as check:
-                        final_dims = check.size
-                        if final_dims != (target_width, target_height):
-                            print(f"CORRIGIENDO dimensiones finales: {final_dims} -> {target_width}x{target_height}")
-                            corrected = check.resize((target_width, target_height), Image.Resampling.LANCZOS)
-                            corrected.save(output_path, 'PNG', optimize=True)
-                else:
-                    img.save(output_path, 'PNG', optimize=True, compress_level=9, pnginfo=None)
-                    message = None
-                    print(f"RESIZE: Sin cambios, manteniendo {original_dimensions}")
-            else:
-                img.save(output_path, 'PNG', optimize=True, compress_level=9, pnginfo=None)
-                message = None
-                print(f"RESIZE: Sin dimensiones, manteniendo {original_dimensions}")
-            
-            return True, message
-            
+        etag = preview_etag(final_path, RESULT_PREVIEW_SIZE)
+        data, mimetype = encode_thumbnail(img, image_format, RESULT_PREVIEW_SIZE)
+        thumbnail_cache.put(etag, os.path.dirname(final_path), data, mimetype, remember=False)
     except Exception as e:
-        return False, f"Error redimensionando: {str(e)}"
+        print(f"⚠ No se pudo generar la miniatura de {os.path.basename(final_path)}: {str(e)}")
+
+def strip_inline_preview(result):
+    """Resultado sin la vista previa en base64, para guardarlo en el almacén de sesiones"""
+    return {key: value for key, value in result.items() if key != 'preview_data'}
 
-def optimize_png_only(image_path, output_path):
-    """Optimizar PNG manteniendo dimensiones originales"""
+# CACHÉ DE RESULTADOS
+result_cache = ResultCache(RESULT_CACHE_FOLDER, RESULT_CACHE_MAX_BYTES)
+
+def result_cache_key(image_info, options):
+    """Clave de caché de una imagen con unas opciones, o None si la caché está desactivada"""
+    if not RESULT_CACHE_ENABLED:
+        return None
+    
+    input_hash = image_info.get('sha256') or file_sha256(image_info['path'])
+    background_removal = bool(options.get('background_removal'))
+    normalized = {
+        'pipeline': PIPELINE_VERSION,
+        'background_removal': background_removal,
+        'rembg_model': REMBG_MODEL if background_removal and REMBG_AVAILABLE else None,
+        'resize': [options['width'], options['height']] if options.get('resize') else None,
+        'png_optimizer': PNG_OPTIMIZER is not None,
+        'jpeg_quality': [JPEG_QUALITY_MIN, JPEG_QUALITY_MAX]
+    }
+    return result_cache.key(input_hash, normalized)
+
+def restore_cached_result(result, final_path, cache_key, options):
+    """
+    Completar `result` con el resultado en caché (copiándolo a la sesión).
+    False si no está; también si la entrada desaparece antes de copiarla
+    (la caché se recorta en otro hilo), para que la imagen se procese normalmente.
+    """
+    cached = result_cache.get(cache_key) if cache_key else None
+    if cached is None:
+        return False
+    
+    data_path, meta = cached
     try:
-        with Image.open(image_path) as img:
-            original_dimensions = img.size
-            print(f"OPTIMIZE: Manteniendo dimensiones: {original_dimensions}")
-            
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
-            
-            img.save(output_path, 'PNG', optimize=True, compress_level=9, pnginfo=None)
-            
-            with Image.open(output_path) as check:
-                if check.size != original_dimensions:
-                    corrected = check.resize(original_dimensions, Image.Resampling.LANCZOS)
-                    corrected.save(output_path, 'PNG', optimize=True)
-            
-            force_size_reduction_safe(output_path, original_dimensions, 8)
-            optimize_with_oxipng(output_path)
-            
-            message = f"PNG optimizado ({original_dimensions[0]}x{original_dimensions[1]})"
-            return True, message
-            
-    except Exception as e:
-        return False, f"Error optimizando PNG: {str(e)}"
+        shutil.copyfile(data_path, final_path)
+        final_size = os.path.getsize(final_path)
+    except OSError as e:
+        print(f"⚠ {result['original_name']}: resultado en caché no disponible, se procesa de nuevo ({str(e)})")
+        return False
+    
+    result['success'] = True
+    result['message'] = 'Procesado exitosamente'
+    result['operations'] = meta['operations']
+    result['final_size'] = final_size
+    result['size_reduction'] = ((result['original_size'] - final_size) / result['original_size']) * 100
+    result['path'] = final_path
+    result['sha256'] = meta['sha256']
+    result['preview_url'] = build_preview_url(options, os.path.dirname(final_path), result['processed_name'], meta['sha256'])
+    result['cache_hit'] = True
+    
+    if options.get('inline_previews'):
+        with Image.open(final_path) as img:
+            result['preview_data'] = create_image_preview_data(img)
+    
+    print(f"✓ {result['original_name']}: resultado en caché ({final_size//1024}KB)")
+    return True
 
-def create_image_preview_data(image_path):
-    """Crear datos de preview de la imagen en base64"""
+def store_cached_result(result, cache_key):
+    """Guardar en caché un resultado correcto"""
+    if not cache_key:
+        return
     try:
-        with Image.open(image_path) as img:
-            img.thumbnail((150, 150), Image.Resampling.LANCZOS)
-            
-            buffer = io.BytesIO()
-            if img.mode in ('RGBA', 'LA'):
-                img.save(buffer, format='PNG')
-            else:
-                img.save(buffer, format='JPEG', quality=70)
-            
-            img_data = buffer.getvalue()
-            import base64
-            b64_data = base64.b64encode(img_data).decode()
-            
-            format_type = 'png' if img.mode in ('RGBA', 'LA') else 'jpeg'
-            return f"data:image/{format_type};base64,{b64_data}"
-    except:
-        return None
+        result_cache.put(cache_key, result['path'], {
+            'operations': result['operations'],
+            'sha256': result['sha256']
+        })
+    except Exception as e:
+        print(f"⚠ No se pudo guardar en caché {result['original_name']}: {str(e)}")
+
+def evict_result_cache():
+    """Pedir que la caché se recorte a RESULT_CACHE_MAX_BYTES (en segundo plano)"""
+    if RESULT_CACHE_ENABLED:
+        result_cache.request_evict()
 
-def process_single_image(image_info, session_folder, options):
-    """Procesar una sola imagen según las opciones"""
+def get_result_cache_status():
+    """Estado de la caché de resultados para /api/health"""
+    if not RESULT_CACHE_ENABLED:
+        return {'enabled': False}
+    return {'enabled': True, **result_cache.stats()}
+
+def resize_target(options):
+    """Dimensiones de salida pedidas, o None si no hay redimensionado"""
+    if options.get('resize'):
+        return (int(options['width']), int(options['height']))
+    return None
+
+def process_single_image(image_info, session_folder, options, mask=None):
+    """
+    Procesar una sola imagen según las opciones.
+    `mask` es la máscara de fondo ya predicha en lote por predict_masks_batch.
+    """
     input_path = image_info['path']
     original_size = os.path.getsize(input_path)
     
     base_name = os.path.splitext(image_info['original_name'])[0]
     output_filename = f"{base_name}.png"
-    temp_path = os.path.join(session_folder, f"temp_{uuid.uuid4()}.png")
     final_path = os.path.join(session_folder, output_filename)
     
     result = {
@@ -379,73 +883,56 @@ def process_single_image(image_info, session_folder, options):
         'original_size': original_size,
         'final_size': None,
         'size_reduction': None,
-        'preview_url': None
+        'preview_url': None,
+        'cache_hit': False
     }
     
-    current_path = input_path
-    temp_files = []
-    
     try:
+        cache_key = result_cache_key(image_info, options)
+        if restore_cached_result(result, final_path, cache_key, options):
+            return result
+        
         has_background_removal = options.get('background_removal', False)
         has_resize = options.get('resize', False)
         png_only = options.get('png_optimize_only', False)
         
         print(f"Procesando {image_info['original_name']}: bg_removal={has_background_removal}, resize={has_resize}, png_only={png_only}")
         
-        if png_only and not has_background_removal and not has_resize:
-            success, message = optimize_png_only(current_path, final_path)
-            if success:
-                result['operations'].append(message)
-            else:
-                result['message'] = message
-                return result
+        pipeline = ImagePipeline(input_path, draft_size=resize_target(options))
         
-        else:
-            if has_background_removal:
-                success, message = remove_background(current_path, temp_path)
+        if has_background_removal:
+            result['operations'].append(pipeline.remove_background(mask))
+        
+        if has_resize:
+            message = pipeline.resize(options.get('width'), options.get('height'))
+            if message:
                 result['operations'].append(message)
-                if success:
-                    current_path = temp_path
-                    temp_files.append(temp_path)
-                else:
-                    result['message'] = message
-                    return result
-            
-            if has_resize:
-                width = options.get('width')
-                height = options.get('height')
-                success, message = resize_image(current_path, final_path, width, height)
-                if message:
-                    result['operations'].append(message)
-                if not success:
-                    result['message'] = message
-                    return result
-            else:
-                if current_path != input_path:
-                    shutil.move(current_path, final_path)
-                    result['operations'].append("Convertido a PNG optimizado")
-                else:
-                    success, message = optimize_png_only(current_path, final_path)
-                    result['operations'].append(message)
+            pipeline.save(final_path)
+        elif has_background_removal:
+            pipeline.reduce_size(15)
+            pipeline.save(final_path, optimize=True)
+            result['operations'].append("Convertido a PNG optimizado")
+        else:
+            pipeline.reduce_size(8)
+            pipeline.save(final_path, optimize=True)
+            result['operations'].append(f"PNG optimizado ({pipeline.size[0]}x{pipeline.size[1]})")
         
         if os.path.exists(final_path):
             final_size = os.path.getsize(final_path)
           
             size_reduction = ((original_size - final_size) / original_size) * 100
-
-            if size_reduction < 0:  
-                size_reduction = ((original_size - final_size) / original_size) * 100
-            else:
-                print(f"⚠ {image_info['original_name']}: {original_size//1024}KB -> {final_size//1024}KB (+{size_reduction:.1f}%)")
-                        
-            preview_url = create_image_preview_data(final_path)
             
             result['success'] = True
             result['message'] = 'Procesado exitosamente'
             result['final_size'] = final_size
             result['size_reduction'] = size_reduction
             result['path'] = final_path
-            result['preview_url'] = preview_url
+            result['sha256'] = file_sha256(final_path)
+            result['preview_url'] = build_preview_url(options, session_folder, output_filename, result['sha256'])
+            pregenerate_thumbnail(final_path, pipeline.image, pipeline.output_format)
+            if options.get('inline_previews'):
+                result['preview_data'] = create_image_preview_data(pipeline.image)
+            store_cached_result(result, cache_key)
         
             if size_reduction > 0:
                 print(f"✓ {image_info['original_name']}: {original_size//1024}KB -> {final_size//1024}KB (-{size_reduction:.1f}%)")
@@ -454,137 +941,720 @@ def process_single_image(image_info, session_folder, options):
         else:
             result['message'] = 'Error: archivo final no encontrado'
     
-    except Exception as e:
-        result['message'] = f'Error procesando: {str(e)}'
-        print(f"✗ Error en {image_info['original_name']}: {str(e)}")
+    except Exception as e:
+        result['message'] = f'Error procesando: {str(e)}'
+        print(f"✗ Error en {image_info['original_name']}: {str(e)}")
+    
+    return result
+
+def is_result_cached(image_info, options):
+    """True si ya hay un resultado en caché para la imagen con estas opciones"""
+    try:
+        cache_key = result_cache_key(image_info, options)
+    except OSError:
+        return False
+    return cache_key is not None and result_cache.get(cache_key) is not None
+
+def mask_batches(files, options):
+    """
+    Grupos de posiciones de `files` cuyas máscaras se predicen en una sola
+    pasada del modelo: imágenes con eliminación de fondo y sin resultado en
+    caché, de REMBG_BATCH_SIZE en REMBG_BATCH_SIZE.
+    """
+    if not (options.get('background_removal', False) and REMBG_AVAILABLE
+            and REMBG_BATCH_SIZE > 1 and REMBG_MODEL in REMBG_BATCH_INPUTS):
+        return []
+    
+    pending = [position for position, image_info in enumerate(files) if not is_result_cached(image_info, options)]
+    groups = [pending[start:start + REMBG_BATCH_SIZE] for start in range(0, len(pending), REMBG_BATCH_SIZE)]
+    return [group for group in groups if len(group) > 1]
+
+# PROCESAMIENTO PARALELO
+_process_executor = None
+_process_executor_lock = threading.Lock()
+
+def get_process_executor():
+    """Pool de procesos compartido, creado en el primer uso"""
+    global _process_executor
+    with _process_executor_lock:
+        if _process_executor is None:
+            _process_executor = ProcessPoolExecutor(
+                max_workers=PROCESS_WORKERS,
+                mp_context=PROCESS_CONTEXT,
+                initializer=init_process_worker,
+                initargs=(_warm_workers, _worker_load_error)
+            )
+            print(f"Pool de procesamiento iniciado con {PROCESS_WORKERS} workers")
+        return _process_executor
+
+def reset_process_executor(broken_executor):
+    """
+    Descartar un pool roto y, con precarga activada, levantar otro en segundo
+    plano: sin workers calientes /readyz no vuelve a estar listo y el
+    balanceador ya no enviaría la petición que lo crearía.
+    """
+    global _process_executor
+    with _process_executor_lock:
+        # Varios lotes del mismo pool roto pueden llegar aquí; solo se reinicia una vez
+        if _process_executor is not broken_executor:
+            return
+        _process_executor.shutdown(wait=False, cancel_futures=True)
+        _process_executor = None
+        with _warm_workers.get_lock():
+            _warm_workers.value = 0
+    
+    if REMBG_AVAILABLE and REMBG_PREWARM:
+        threading.Thread(target=prewarm_processing, daemon=True).start()
+
+# Tareas enviadas que aún no han terminado (en un worker o esperando uno)
+_active_batches = 0
+_active_batches_lock = threading.Lock()
+
+def track_batches(delta):
+    global _active_batches
+    with _active_batches_lock:
+        _active_batches += delta
+
+def worker_error_result(file_info, error):
+    return {
+        'id': file_info['id'],
+        'original_name': file_info['original_name'],
+        'success': False,
+        'message': f'Error en worker de procesamiento: {str(error)}'
+    }
+
+def process_images_parallel(files, session_folder, options, on_result=None):
+    """
+    Procesar varias imágenes, cada una en su propia tarea del pool de procesos.
+    Con eliminación de fondo solo la inferencia va en lotes (predict_masks_batch);
+    decodificar, codificar y optimizar cada imagen se reparte entre los workers.
+    Los resultados se devuelven en el mismo orden que `files`; `on_result(posición, resultado)`
+    se llama a medida que cada imagen termina.
+    """
+    results = [None] * len(files)
+    groups = mask_batches(files, options)
+    
+    def collect(position, result):
+        results[position] = result
+        if on_result:
+            on_result(position, result)
+    
+    if PROCESS_WORKERS <= 1:
+        masks = {}
+        for group in groups:
+            track_batches(1)
+            try:
+                masks.update(zip(group, predict_masks_batch([files[position] for position in group])))
+            finally:
+                track_batches(-1)
+        for position, file_info in enumerate(files):
+            track_batches(1)
+            try:
+                result = process_single_image(file_info, session_folder, options, masks.get(position))
+            finally:
+                track_batches(-1)
+            collect(position, result)
+        return results
+    
+    # Con varios workers todo pasa por el pool, también una sola imagen: el
+    # modelo solo está precargado en los workers
+    futures = {}
+    
+    def submit(kind, payload, function, *args):
+        executor = get_process_executor()
+        track_batches(1)
+        try:
+            future = executor.submit(function, *args)
+        except Exception as e:
+            # Pool roto antes de enviar: la tarea falla como si hubiera fallado el worker
+            future = Future()
+            future.set_exception(e)
+        futures[future] = (kind, payload, executor)
+    
+    grouped = set()
+    for group in groups:
+        submit('masks', group, predict_masks_batch, [files[position] for position in group])
+        grouped.update(group)
+    for position, file_info in enumerate(files):
+        if position not in grouped:
+            submit('image', position, process_single_image, file_info, session_folder, options)
+    
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            kind, payload, executor = futures.pop(future)
+            track_batches(-1)
+            positions = payload if kind == 'masks' else [payload]
+            try:
+                value = future.result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    reset_process_executor(executor)
+                for position in positions:
+                    collect(position, worker_error_result(files[position], e))
+                continue
+            
+            if kind == 'masks':
+                for position, mask in zip(positions, value):
+                    submit('image', position, process_single_image, files[position], session_folder, options, mask)
+            else:
+                collect(payload, value)
+    
+    return results
+
+def build_processing_options(data):
+    """Opciones de procesamiento a partir del cuerpo de /api/process"""
+    background_removal = data.get('background_removal', False)
+    resize = data.get('resize', False)
+    width = data.get('width')
+    height = data.get('height')
+    
+    actual_resize = resize and width and height and int(width) > 0 and int(height) > 0
+    
+    options = {
+        'background_removal': background_removal,
+        'resize': actual_resize,
+        'width': int(width) if width and str(width).strip() != '' else None,
+        'height': int(height) if height and str(height).strip() != '' else None,
+        'png_optimize_only': False,
+        'inline_previews': bool(data.get('inline_previews', False))
+    }
+    
+    if not background_removal and not actual_resize:
+        options['png_optimize_only'] = True
+    
+    return options
+
+def process_session(session_id, files, options, on_result=None):
+    """
+    Procesar todas las imágenes de una sesión, guardando cada resultado en el
+    almacén de sesiones al terminar. `on_result(índice, resultado)` recibe
+    cada imagen al terminar.
+    """
+    session_folder = os.path.join(UPLOAD_FOLDER, session_id)
+    
+    if options['png_optimize_only']:
+        print(f"Modo: Solo optimización para {len(files)} imágenes")
+    else:
+        print(f"Procesando {len(files)} imágenes: bg_removal={options['background_removal']}, resize={options['resize']}")
+        if options['resize']:
+            print(f"Dimensiones objetivo: {options['width']}x{options['height']}")
+    
+    processed_results = [None] * len(files)
+    pending = []
+    channel = start_session_events(session_id, len(files))
+    
+    def handle_result(index, result):
+        processed_results[index] = result
+        try:
+            session_store.save_result(session_id, index, strip_inline_preview(result))
+        except Exception as e:
+            print(f"Error guardando resultado: {str(e)}")
+        if RESULT_CACHE_ENABLED and result['success']:
+            try:
+                cache_key = result_cache_key(files[index], options)
+            except OSError:
+                cache_key = None
+            result_cache.record(result.get('cache_hit', False), result['final_size'], cache_key)
+        publish_session_event(channel, 'result', {'index': index, 'result': result})
+        if result['success']:
+            print(f"{result['original_name']} -> {result['final_size']//1024}KB (-{result['size_reduction']:.1f}%)")
+        else:
+            print(f"ERROR {result['original_name']}: {result['message']}")
+        if on_result:
+            on_result(index, result)
+    
+    for index, file_info in enumerate(files):
+        if not os.path.exists(file_info['path']):
+            handle_result(index, {
+                'id': file_info['id'],
+                'original_name': file_info['original_name'],
+                'success': False,
+                'message': 'Archivo no encontrado'
+            })
+            continue
+        pending.append((index, file_info))
+    
+    # Los resultados ocupan al menos lo mismo que las entradas
+    with storage_governor.in_use(session_folder):
+        storage_governor.ensure_space(sum(f.get('size', 0) for _, f in pending), reject=False)
+        try:
+            process_images_parallel([f for _, f in pending], session_folder, options,
+                                    on_result=lambda position, result: handle_result(pending[position][0], result))
+        finally:
+            finish_session_events(channel, [r for r in processed_results if r is not None])
+            index_preview_files(session_folder, [r['path'] for r in processed_results if r and r.get('path')])
+            evict_result_cache()
+    
+    if os.path.isdir(session_folder):
+        storage_governor.track(session_folder, processed=True)
+    
+    try:
+        session_store.mark_processed(session_id, datetime.now().isoformat(), options)
+    except Exception as e:
+        print(f"Error guardando metadatos: {str(e)}")
+    
+    return processed_results
+
+def summarize_results(processed_results):
+    """Estadísticas de un procesamiento"""
+    successful = sum(1 for r in processed_results if r['success'])
+    return {
+        'total': len(processed_results),
+        'successful': successful,
+        'failed': len(processed_results) - successful
+    }
+
+# EVENTOS DE PROCESAMIENTO (SSE)
+_session_events = {}
+_session_events_cond = threading.Condition()
+
+def start_session_events(session_id, total):
+    """Abrir un canal de eventos nuevo para un procesamiento de la sesión"""
+    channel = {'events': [], 'done': False, 'finished_at': None}
+    with _session_events_cond:
+        purge_finished_event_channels()
+        previous = _session_events.get(session_id)
+        if previous is not None:
+            previous['done'] = True
+        _session_events[session_id] = channel
+        channel['events'].append(('start', {'session_id': session_id, 'total': total}))
+        _session_events_cond.notify_all()
+    return channel
+
+def publish_session_event(channel, event, data):
+    with _session_events_cond:
+        channel['events'].append((event, data))
+        _session_events_cond.notify_all()
+
+def finish_session_events(channel, results):
+    with _session_events_cond:
+        channel['events'].append(('done', summarize_results(results)))
+        channel['done'] = True
+        channel['finished_at'] = time.time()
+        _session_events_cond.notify_all()
+
+def purge_finished_event_channels():
+    """Olvidar canales terminados hace más de JOB_TTL (llamar con el lock)"""
+    limit = time.time() - JOB_TTL.total_seconds()
+    for session_id in [session_id for session_id, channel in _session_events.items()
+                       if channel['finished_at'] and channel['finished_at'] < limit]:
+        del _session_events[session_id]
+
+def format_sse(event, data, event_id=None):
+    message = f"event: {event}\n"
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def iter_session_events(session_id, position=0, wait_next=False):
+    """
+    Generar los eventos SSE del procesamiento de una sesión.
+    Repite los eventos ya emitidos desde `position` y sigue hasta el evento 'done'.
+    Con `wait_next`, ignora un procesamiento ya terminado y espera al siguiente.
+    """
+    yield ": conectado\n\n"
+    
+    skipped = None
+    with _session_events_cond:
+        channel = _session_events.get(session_id)
+        if wait_next and channel is not None and channel['done']:
+            skipped = channel
+            channel = None
+    
+    while True:
+        with _session_events_cond:
+            if channel is None:
+                current = _session_events.get(session_id)
+                if current is not None and (not wait_next or current is not skipped):
+                    channel = current
+            
+            if channel is None or (position >= len(channel['events']) and not channel['done']):
+                _session_events_cond.wait(timeout=SSE_KEEPALIVE_SECONDS)
+            
+            pending = channel['events'][position:] if channel is not None else []
+            done = channel is not None and channel['done']
+        
+        if not pending and not done:
+            yield ": keep-alive\n\n"
+            continue
+        
+        for event, data in pending:
+            yield format_sse(event, data, position)
+            position += 1
+        
+        if done and position >= len(channel['events']):
+            break
+
+# TRABAJOS ASÍNCRONOS
+JOBS = {}
+_jobs_lock = threading.Lock()
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+
+def create_processing_job(session_id, files, options):
+    """Registrar un trabajo de procesamiento y encolarlo en segundo plano"""
+    job_id = str(uuid.uuid4())
+    job = {
+        'job_id': job_id,
+        'session_id': session_id,
+        'status': 'queued',
+        'created_at': datetime.now().isoformat(),
+        'started_at': None,
+        'finished_at': None,
+        'total': len(files),
+        'completed': 0,
+        'images': [{
+            'id': file_info['id'],
+            'original_name': file_info['original_name'],
+            'status': 'pending'
+        } for file_info in files],
+        'results': [None] * len(files),
+        'stats': None,
+        'error': None
+    }
+    
+    with _jobs_lock:
+        purge_expired_jobs()
+        JOBS[job_id] = job
+    
+    # La sesión queda protegida mientras el trabajo espera en la cola
+    storage_governor.acquire(os.path.join(UPLOAD_FOLDER, session_id))
+    _job_executor.submit(run_processing_job, job, files, options)
+    return job
+
+def run_processing_job(job, files, options):
+    """Ejecutar un trabajo actualizando su progreso imagen por imagen"""
+    with _jobs_lock:
+        job['status'] = 'running'
+        job['started_at'] = datetime.now().isoformat()
+        for image in job['images']:
+            image['status'] = 'processing'
+    
+    def on_result(index, result):
+        with _jobs_lock:
+            job['images'][index]['status'] = 'done' if result['success'] else 'error'
+            job['results'][index] = result
+            job['completed'] += 1
     
+    try:
+        processed_results = process_session(job['session_id'], files, options, on_result=on_result)
+        stats = summarize_results(processed_results)
+        with _jobs_lock:
+            job['status'] = 'completed'
+            job['stats'] = stats
+        print(f"Trabajo {job['job_id']} completado: {stats['successful']} exitosos, {stats['failed']} fallidos")
+    except Exception as e:
+        with _jobs_lock:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        print(f"✗ Trabajo {job['job_id']} fallido: {str(e)}")
     finally:
-        for temp_file in temp_files:
-            if os.path.exists(temp_file) and temp_file != final_path:
-                try:
-                    os.remove(temp_file)
-                except:
-                    pass
+        storage_governor.release(os.path.join(UPLOAD_FOLDER, job['session_id']))
+        with _jobs_lock:
+            job['finished_at'] = datetime.now().isoformat()
+
+def purge_expired_jobs():
+    """Olvidar trabajos terminados hace más de JOB_TTL (llamar con _jobs_lock)"""
+    limit = (datetime.now() - JOB_TTL).isoformat()
+    for job_id in [job_id for job_id, job in JOBS.items()
+                   if job['finished_at'] and job['finished_at'] < limit]:
+        del JOBS[job_id]
+
+def get_job_snapshot(job_id):
+    """Copia del estado de un trabajo para responder por JSON"""
+    with _jobs_lock:
+        job = JOBS.get(job_id)
+        if job is None:
+            return None
+        
+        total = job['total']
+        return {
+            'job_id': job['job_id'],
+            'session_id': job['session_id'],
+            'status': job['status'],
+            'created_at': job['created_at'],
+            'started_at': job['started_at'],
+            'finished_at': job['finished_at'],
+            'total': total,
+            'completed': job['completed'],
+            'progress': round(job['completed'] / total * 100, 1) if total else 100.0,
+            'images': [dict(image) for image in job['images']],
+            'results': [result for result in job['results'] if result is not None],
+            'stats': job['stats'],
+            'error': job['error']
+        }
+
+def prewarm_processing():
+    """Precargar el modelo rembg en los workers (o en este proceso) al arrancar"""
+    if PROCESS_WORKERS <= 1:
+        warm_rembg_session()
+        return
     
-    return result
+    executor = get_process_executor()
+    for future in [executor.submit(os.getpid) for _ in range(PROCESS_WORKERS)]:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"✗ Error iniciando workers: {str(e)}")
+
+# ESTADO DEL SERVIDOR
+def probe_capabilities():
+    """Herramientas, modelos y códecs disponibles (lanza procesos: no llamar por petición)"""
+    return {
+        'oxipng': {
+            'python': pyoxipng is not None,
+            'cli': command_version('oxipng')
+        },
+        'pngquant': command_version('pngquant'),
+        'rembg': {
+            'available': REMBG_AVAILABLE,
+            'model': REMBG_MODEL,
+            'downloaded_models': rembg_models()
+        },
+        'pillow': pillow_info()
+    }
+
+capability_probe = CapabilityProbe(probe_capabilities, CAPABILITY_REFRESH_SECONDS)
+
+# ARRANQUE DE LOS HILOS EN SEGUNDO PLANO
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background_services():
+    """
+    Arrancar caducidad de sesiones, caché de resultados, precarga del modelo
+    y detección de capacidades, una sola vez y solo en el proceso que sirve
+    peticiones. No se hace al importar: los workers del pool importan este
+    módulo, y con el recargador de Werkzeug también lo importa el proceso
+    que vigila los archivos, que tendría su propio planificador sobre
+    uploads/ (sin ver las renovaciones de plazo) y su propio pool.
+    """
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        session_expiry.start()
+        schedule_existing_sessions()
+        if RESULT_CACHE_ENABLED:
+            result_cache.start()
+        if REMBG_AVAILABLE and REMBG_PREWARM:
+            threading.Thread(target=prewarm_processing, daemon=True).start()
+        capability_probe.start()
+        _background_started = True
+
+@app.before_request
+def ensure_background_services():
+    start_background_services()
+
+def get_capacity_status():
+    """Carga actual: lotes en el pool y trabajos asíncronos"""
+    with _active_batches_lock:
+        batches = _active_batches
+    with _jobs_lock:
+        jobs_queued = sum(1 for job in JOBS.values() if job['status'] == 'queued')
+        jobs_running = sum(1 for job in JOBS.values() if job['status'] == 'running')
+    
+    return {
+        'process_workers': PROCESS_WORKERS,
+        'busy_workers': min(batches, PROCESS_WORKERS),
+        'queued_batches': max(batches - PROCESS_WORKERS, 0),
+        'job_workers': JOB_WORKERS,
+        'jobs_running': jobs_running,
+        'jobs_queued': jobs_queued
+    }
+
+def get_readiness(capacity, rembg_status, storage):
+    """Motivos para no recibir tráfico (lista vacía si el nodo está listo)"""
+    reasons = []
+    if REMBG_AVAILABLE and REMBG_PREWARM and not rembg_status['ready'] and not rembg_status['error']:
+        reasons.append('Modelo rembg cargándose')
+    if capacity['queued_batches'] >= READY_MAX_QUEUED_BATCHES:
+        reasons.append(f"{capacity['queued_batches']} lotes esperando worker")
+    if capacity['jobs_queued'] >= READY_MAX_QUEUED_JOBS:
+        reasons.append(f"{capacity['jobs_queued']} trabajos en cola")
+    if storage['disk_used_ratio'] is not None and storage['disk_used_ratio'] > STORAGE_HIGH_WATERMARK:
+        reasons.append(f"Disco al {storage['disk_used_ratio']:.0%}")
+    return reasons
 
 # ENDPOINTS
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    oxipng_available = False
-    try:
-        result = subprocess.run(['oxipng', '--version'], 
-                              capture_output=True, text=True, timeout=5)
-        oxipng_available = result.returncode == 0
-    except:
-        pass
+    """Estado completo: capacidades (detectadas en segundo plano) y carga actual"""
+    rembg_status = get_rembg_status()
+    capacity = get_capacity_status()
+    storage = storage_governor.stats()
+    not_ready = get_readiness(capacity, rembg_status, storage)
     
     return jsonify({
         'status': 'ok',
         'message': 'ImageProcessor Backend funcionando',
+        'ready': not not_ready,
+        'not_ready_reasons': not_ready,
         'rembg_available': REMBG_AVAILABLE,
-        'oxipng_available': oxipng_available,
+        'rembg': rembg_status,
+        'oxipng_available': PNG_OPTIMIZER is not None,
+        'png_optimizer': PNG_OPTIMIZER,
+        'capabilities': capability_probe.get(),
+        'capacity': capacity,
+        'result_cache': get_result_cache_status(),
+        'thumbnail_cache': thumbnail_cache.stats(),
+        'session_expiry': session_expiry.stats(),
+        'storage': storage,
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/livez', methods=['GET'])
+def liveness():
+    """El proceso responde; no mira dependencias para que un nodo ocupado no se reinicie"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readiness():
+    """503 mientras el modelo se carga, el pool está saturado o el disco está lleno"""
+    not_ready = get_readiness(get_capacity_status(), get_rembg_status(), storage_governor.stats())
+    if not_ready:
+        return jsonify({'status': 'not_ready', 'reasons': not_ready}), 503
+    return jsonify({'status': 'ready'})
+
+def storage_shortage_response(shortage):
+    """Respuesta a una subida que no cabe: 429 si cabrá al terminar las sesiones en uso, si no 507"""
+    if shortage == 'busy':
+        response = jsonify({'error': 'Servidor sin espacio temporalmente, reintenta en unos segundos'})
+        response.headers['Retry-After'] = str(STORAGE_RETRY_AFTER)
+        return response, 429
+    return jsonify({'error': 'No hay espacio suficiente en el servidor para esta subida'}), 507
+
 @app.route('/api/upload', methods=['POST'])
 def upload_files():
-    if 'files' not in request.files:
+    """
+    Recibir archivos en streaming: cada parte multipart se escribe una sola
+    vez en la sesión, con su hash y su firma comprobados al vuelo.
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
         return jsonify({'error': 'No se encontraron archivos'}), 400
     
-    files = request.files.getlist('files')
+    # El Content-Length lo declara el cliente: por encima del máximo se rechaza
+    # antes de usarlo para liberar espacio (eliminaría sesiones para nada)
+    max_length = request.max_content_length
+    content_length = request.content_length or 0
+    if max_length is not None and content_length > max_length:
+        return jsonify({'error': f'La subida supera el máximo de {max_length // (1024 * 1024)}MB'}), 413
     
-    if not files or all(f.filename == '' for f in files):
-        return jsonify({'error': 'No se seleccionaron archivos'}), 400
+    # Hacer sitio antes de recibir nada; sin Content-Length solo se mira el uso actual
+    shortage = storage_governor.ensure_space(content_length)
+    if shortage:
+        return storage_shortage_response(shortage)
     
     session_id = str(uuid.uuid4())
     session_folder = os.path.join(UPLOAD_FOLDER, session_id)
     os.makedirs(session_folder, exist_ok=True)
     
     uploaded_files = []
-    errors = []
     zip_count = 0
     direct_count = 0
     
     try:
-        for file in files:
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                unique_filename = f"{uuid.uuid4()}_{filename}"
-                file_path = os.path.join(session_folder, unique_filename)
+        received, errors, file_parts = receive_multipart_files(
+            request.stream, boundary.encode('latin-1'), session_folder, allowed_file,
+            max_parts=request.max_form_parts
+        )
+    except RequestEntityTooLarge:
+        session_expiry.trash(session_folder)
+        return jsonify({'error': f'La subida supera el máximo de {request.max_content_length // (1024 * 1024)}MB'}), 413
+    except ValueError as e:
+        # Cuerpo multipart truncado o mal formado: error del cliente
+        session_expiry.trash(session_folder)
+        return jsonify({'error': f'Cuerpo de la subida no válido: {str(e)}'}), 400
+    except Exception as e:
+        session_expiry.trash(session_folder)
+        return jsonify({'error': f'Error procesando archivos: {str(e)}'}), 500
+    
+    if file_parts == 0:
+        session_expiry.trash(session_folder)
+        return jsonify({'error': 'No se seleccionaron archivos'}), 400
+    
+    try:
+        for file in received:
+            filename = file['original_name']
+            file_path = file['path']
+            
+            if filename.lower().endswith('.zip'):
+                zip_count += 1
+                shortage = ensure_zip_space(file_path)
+                if shortage:
+                    session_expiry.trash(session_folder)
+                    return storage_shortage_response(shortage)
                 
-                file.save(file_path)
+                extracted_images, error = extract_images_from_zip(file_path, session_folder)
+                os.remove(file_path)
                 
-                if filename.lower().endswith('.zip'):
-                    zip_count += 1
-                    extracted_images, error = extract_images_from_zip(file_path, session_folder)
-                    
-                    if error:
-                        errors.append(f"Error extrayendo {filename}: {error}")
-                        continue
-                    
-                    if not extracted_images:
-                        errors.append(f"No se encontraron imágenes válidas en {filename}")
-                        continue
-                    
-                    for img in extracted_images:
-                        uploaded_files.append({
-                            'id': str(uuid.uuid4()),
-                            'filename': img['filename'],
-                            'original_name': img['original_name'],
-                            'type': 'image',
-                            'source': 'zip',
-                            'size': img['size'],
-                            'path': img['path']
-                        })
-                    os.remove(file_path)
+                if error:
+                    errors.append(f"Error extrayendo {filename}: {error}")
+                    continue
                 
-                else:
-                    direct_count += 1
-                    file_size = os.path.getsize(file_path)
+                if not extracted_images:
+                    errors.append(f"No se encontraron imágenes válidas en {filename}")
+                    continue
+                
+                for img in extracted_images:
                     uploaded_files.append({
                         'id': str(uuid.uuid4()),
-                        'filename': unique_filename,
-                        'original_name': filename,
+                        'filename': img['filename'],
+                        'original_name': img['original_name'],
                         'type': 'image',
-                        'source': 'direct',
-                        'size': file_size,
-                        'path': file_path
+                        'source': 'zip',
+                        'size': img['size'],
+                        'sha256': img['sha256'],
+                        'path': img['path']
                     })
             
             else:
-                errors.append(f"Archivo no permitido: {file.filename if file.filename else 'sin nombre'}")
+                direct_count += 1
+                uploaded_files.append({
+                    'id': str(uuid.uuid4()),
+                    'filename': file['filename'],
+                    'original_name': filename,
+                    'type': 'image',
+                    'source': 'direct',
+                    'size': file['size'],
+                    'sha256': file['sha256'],
+                    'path': file_path
+                })
     
     except Exception as e:
-        if os.path.exists(session_folder):
-            shutil.rmtree(session_folder)
+        session_expiry.trash(session_folder)
         return jsonify({'error': f'Error procesando archivos: {str(e)}'}), 500
     
     if not uploaded_files:
-        if os.path.exists(session_folder):
-            shutil.rmtree(session_folder)
-        return jsonify({'error': 'No se encontraron archivos válidos'}), 400
+        session_expiry.trash(session_folder)
+        return jsonify({'error': 'No se encontraron archivos válidos', 'errors': errors}), 400
     
     upload_type = 'single' if direct_count == 1 and zip_count == 0 and len(uploaded_files) == 1 else 'multiple'
     
-    session_metadata = {
-        'session_id': session_id,
-        'created_at': datetime.now().isoformat(),
-        'files': uploaded_files,
-        'errors': errors,
-        'processed': False,
-        'upload_type': upload_type,
-        'stats': {
-            'direct_files': direct_count,
-            'zip_files': zip_count,
-            'total_images': len(uploaded_files)
-        }
-    }
+    try:
+        session_store.create_session(
+            session_id,
+            datetime.now().isoformat(),
+            uploaded_files,
+            errors=errors,
+            upload_type=upload_type,
+            stats={
+                'direct_files': direct_count,
+                'zip_files': zip_count,
+                'total_images': len(uploaded_files)
+            }
+        )
+    except Exception as e:
+        session_expiry.trash(session_folder)
+        return jsonify({'error': f'Error guardando sesión: {str(e)}'}), 500
     
-    metadata_path = os.path.join(session_folder, 'metadata.json')
-    with open(metadata_path, 'w', encoding='utf-8') as f:
-        json.dump(session_metadata, f, indent=2, ensure_ascii=False)
+    index_preview_files(session_folder, [f['path'] for f in uploaded_files])
+    schedule_session_cleanup(session_folder, delay=SESSION_TTL)
+    storage_governor.track(session_folder)
     
     print(f"Cargados {len(uploaded_files)} archivos en sesión {session_id}")
     
@@ -605,88 +1675,197 @@ def process_images():
         return jsonify({'error': 'session_id requerido'}), 400
     
     session_id = data['session_id']
-    session_folder = os.path.join(UPLOAD_FOLDER, session_id)
-    metadata_path = os.path.join(session_folder, 'metadata.json')
-    
-    if not os.path.exists(metadata_path):
-        return jsonify({'error': 'Sesión no encontrada'}), 404
     
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
+        session = load_session(session_id)
+        files = session_store.get_files(session_id) if session else []
     except Exception as e:
         return jsonify({'error': f'Error leyendo metadatos: {str(e)}'}), 500
     
-    background_removal = data.get('background_removal', False)
-    resize = data.get('resize', False)
-    width = data.get('width')
-    height = data.get('height')
-    
-    actual_resize = resize and width and height and int(width) > 0 and int(height) > 0
+    if session is None:
+        return jsonify({'error': 'Sesión no encontrada'}), 404
     
-    options = {
-        'background_removal': background_removal,
-        'resize': actual_resize,
-        'width': int(width) if width and str(width).strip() != '' else None,
-        'height': int(height) if height and str(height).strip() != '' else None,
-        'png_optimize_only': False
-    }
+    # El plazo de caducidad cuenta desde la última actividad de la sesión
+    schedule_session_cleanup(os.path.join(UPLOAD_FOLDER, session_id), delay=SESSION_TTL)
     
-    if not background_removal and not actual_resize:
-        options['png_optimize_only'] = True
-        print(f"Modo: Solo optimización para {len(metadata['files'])} imágenes")
-    else:
-        print(f"Procesando {len(metadata['files'])} imágenes: bg_removal={background_removal}, resize={actual_resize}")
-        if actual_resize:
-            print(f"Dimensiones objetivo: {options['width']}x{options['height']}")
+    options = build_processing_options(data)
+    options['preview_base_url'] = request.url_root.rstrip('/')
     
-    processed_results = []
+    if data.get('async', False):
+        job = create_processing_job(session_id, files, options)
+        return jsonify({
+            'success': True,
+            'message': 'Procesamiento en cola',
+            'session_id': session_id,
+            'job_id': job['job_id'],
+            'status': job['status'],
+            'status_url': f"/api/jobs/{job['job_id']}"
+        }), 202
     
-    for file_info in metadata['files']:
-        if not os.path.exists(file_info['path']):
-            processed_results.append({
-                'id': file_info['id'],
-                'original_name': file_info['original_name'],
-                'success': False,
-                'message': 'Archivo no encontrado'
-            })
-            continue
-        
-        result = process_single_image(file_info, session_folder, options)
-        processed_results.append(result)
-        
-        if result['success']:
-            print(f"{result['original_name']} -> {result['final_size']//1024}KB (-{result['size_reduction']:.1f}%)")
-        else:
-            print(f"ERROR {result['original_name']}: {result['message']}")
+    processed_results = process_session(session_id, files, options)
+    stats = summarize_results(processed_results)
     
-    metadata['processed'] = True
-    metadata['processed_at'] = datetime.now().isoformat()
-    metadata['processing_options'] = options
-    metadata['results'] = processed_results
+    print(f"Completado: {stats['successful']} exitosos, {stats['failed']} fallidos")
     
+    return jsonify({
+        'success': True,
+        'message': f"Procesamiento completado: {stats['successful']} exitosos, {stats['failed']} fallidos",
+        'session_id': session_id,
+        'results': processed_results,
+        'stats': stats
+    })
+
+@app.route('/api/process/<session_id>/events', methods=['GET'])
+def process_events(session_id):
+    """
+    Stream SSE con un evento 'result' por imagen a medida que termina,
+    más 'start' y 'done' (con estadísticas) por cada procesamiento.
+    """
     try:
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        session = load_session(session_id)
     except Exception as e:
-        print(f"Error guardando metadatos: {str(e)}")
+        return jsonify({'error': f'Error leyendo sesión: {str(e)}'}), 500
     
-    successful = sum(1 for r in processed_results if r['success'])
-    failed = len(processed_results) - successful
+    if session is None:
+        return jsonify({'error': 'Sesión no encontrada'}), 404
     
-    print(f"Completado: {successful} exitosos, {failed} fallidos")
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    position = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+    wait_next = request.args.get('next') == '1' and position == 0
     
-    return jsonify({
-        'success': True,
-        'message': f'Procesamiento completado: {successful} exitosos, {failed} fallidos',
-        'session_id': session_id,
-        'results': processed_results,
-        'stats': {
-            'total': len(processed_results),
-            'successful': successful,
-            'failed': failed
+    return Response(
+        stream_with_context(iter_session_events(session_id, position, wait_next)),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
         }
-    })
+    )
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    job = get_job_snapshot(job_id)
+    
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    
+    return jsonify(job)
+
+def serve_processed_file(file_path, download_name, mimetype, session_folder, etag=None):
+    """
+    Responder con un archivo procesado sin copiarlo a memoria.
+    Admite Range, If-Range e If-None-Match con el ETag del contenido. Con
+    'sendfile' la sesión se limpia cuando la respuesta entrega el final del
+    archivo; si el envío lo hace el servidor web, se espera
+    OFFLOAD_CLEANUP_DELAY segundos.
+    """
+    if DOWNLOAD_SERVE_MODE in ('x-accel', 'x-sendfile'):
+        response = Response(mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        if etag:
+            response.set_etag(etag)
+        
+        if DOWNLOAD_SERVE_MODE == 'x-accel':
+            relative_path = os.path.relpath(file_path, UPLOAD_FOLDER).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative_path)
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(file_path)
+        
+        schedule_session_cleanup(session_folder, delay=OFFLOAD_CLEANUP_DELAY)
+        return response
+    
+    schedule_session_cleanup(session_folder, delay=DOWNLOAD_GRACE_TTL)
+    
+    response = send_file(
+        os.path.abspath(file_path),
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=download_name,
+        conditional=True,
+        etag=etag if etag else True
+    )
+    
+    if is_complete_transfer(response):
+        call_on_file_close(response, lambda: schedule_session_cleanup(session_folder, delay=3))
+    return response
+
+def is_complete_transfer(response):
+    """
+    True si la respuesta deja al cliente con el archivo completo: 200, 304
+    o un rango que llega hasta el último byte.
+    """
+    if response.status_code in (200, 304):
+        return True
+    if response.status_code == 206 and response.content_range:
+        return response.content_range.stop == response.content_range.length
+    return False
+
+def call_on_file_close(response, callback):
+    """
+    Ejecutar `callback` cuando el servidor cierre el archivo de send_file.
+    send_file entrega el file wrapper directamente al servidor (sin pasar por
+    response.close), así que el aviso se engancha en el close() del wrapper
+    para no perder el envío con sendfile. Las respuestas sin cuerpo (304)
+    sí pasan por response.close.
+    """
+    called = []
+    
+    def notify():
+        if not called:
+            called.append(True)
+            callback()
+    
+    response.call_on_close(notify)
+    
+    file_wrapper = response.response
+    original_close = getattr(file_wrapper, 'close', None)
+    
+    def close():
+        try:
+            if original_close:
+                original_close()
+        finally:
+            notify()
+    
+    try:
+        file_wrapper.close = close
+    except AttributeError:
+        pass
+
+def zip_archive_etag(entries, results_by_path):
+    """
+    ETag del ZIP de una sesión: hash de los hashes de contenido, nombres,
+    compresión y fechas de las entradas, más la versión del formato (todo
+    lo que determina sus bytes).
+    """
+    digest = hashlib.sha256()
+    digest.update(f"zip:{zip_stream.FORMAT_VERSION}\n".encode('utf-8'))
+    for path, arcname, compress_type in entries:
+        content_hash = results_by_path.get(path, {}).get('sha256') or file_sha256(path)
+        date_time = datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y%m%d%H%M%S')
+        digest.update(f"{arcname}\0{content_hash}\0{compress_type}\0{date_time}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def materialize_zip(session_folder, entries, etag):
+    """
+    Guardar en la sesión el ZIP que se envía en streaming, para responder a
+    peticiones Range. Los bytes son los mismos que los del stream, así que
+    un cliente puede reanudar una descarga cortada con If-Range.
+    """
+    zip_path = os.path.join(session_folder, f".download-{etag[:16]}.zip")
+    if os.path.exists(zip_path):
+        return zip_path
+    
+    tmp_path = f"{zip_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter_zip_stream(entries):
+                f.write(chunk)
+        os.replace(tmp_path, zip_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return zip_path
 
 @app.route('/api/download/<session_id>', methods=['GET'])
 def download_processed(session_id):
@@ -694,21 +1873,26 @@ def download_processed(session_id):
     Descargar imágenes procesadas y limpiar sesión automáticamente después.
     """
     session_folder = os.path.join(UPLOAD_FOLDER, session_id)
-    metadata_path = os.path.join(session_folder, 'metadata.json')
-    
-    if not os.path.exists(metadata_path):
-        return jsonify({'error': 'Sesión no encontrada'}), 404
     
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
+        session = load_session(session_id)
     except Exception as e:
         return jsonify({'error': f'Error leyendo sesión: {str(e)}'}), 500
     
-    if not metadata.get('processed', False):
+    if session is None:
+        return jsonify({'error': 'Sesión no encontrada'}), 404
+    
+    compression = request.args.get('compression', 'auto')
+    if compression not in zip_stream.COMPRESSION_MODES:
+        return jsonify({'error': f"compression debe ser uno de: {', '.join(zip_stream.COMPRESSION_MODES)}"}), 400
+    
+    if not session['processed']:
         return jsonify({'error': 'Imágenes no procesadas'}), 400
     
-    successful_files = [r for r in metadata.get('results', []) if r.get('success', False)]
+    try:
+        successful_files = session_store.get_results(session_id, successful_only=True)
+    except Exception as e:
+        return jsonify({'error': f'Error leyendo sesión: {str(e)}'}), 500
     
     if not successful_files:
         
@@ -729,157 +1913,258 @@ def download_processed(session_id):
                 schedule_session_cleanup(session_folder, delay=1)
                 return jsonify({'error': 'Archivo procesado está vacío'}), 500
             
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            
-            schedule_session_cleanup(session_folder, delay=3)
-            
-            from flask import Response
-            
-            if file_path.endswith('.jpg') or file_path.endswith('.jpeg'):
-                from flask import Response
-            
             if file_path.endswith('.jpg') or file_path.endswith('.jpeg'):
                 mimetype = 'image/jpeg'
             else:
                 mimetype = 'image/png'
             
-            response = Response(
-                file_data,
-                mimetype=mimetype,
-                headers={
-                    'Content-Disposition': f'attachment; filename="{result["processed_name"]}"',
-                    'Content-Type': mimetype,
-                    'Content-Length': str(len(file_data))
-                }
-            )
+            etag = result.get('sha256') or file_sha256(file_path)
+            response = serve_processed_file(file_path, result['processed_name'], mimetype, session_folder, etag=etag)
             
-            print(f"Descarga individual iniciada: {result['processed_name']} ({file_size//1024}KB)")
+            print(f"Descarga individual iniciada: {result['processed_name']} "
+                  f"({file_size//1024}KB, {DOWNLOAD_SERVE_MODE}, {response.status_code})")
             return response
             
+        except HTTPException:
+            raise
         except Exception as e:
             schedule_session_cleanup(session_folder, delay=1)
             return jsonify({'error': f'Error descargando archivo: {str(e)}'}), 500
     
     zip_filename = f"imagenes_procesadas_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
     
+    entries = [(result['path'], result['processed_name']) for result in successful_files
+               if result.get('path') and os.path.exists(result['path']) and os.path.getsize(result['path']) > 0]
+    
+    if not entries:
+        schedule_session_cleanup(session_folder, delay=1)
+        return jsonify({'error': 'ZIP creado pero está vacío'}), 500
+    
     try:
-        from io import BytesIO
-        zip_buffer = BytesIO()
-        
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zipf:
-            for result in successful_files:
-                file_path = result.get('path')
-                if file_path and os.path.exists(file_path):
-                    if os.path.getsize(file_path) > 0:
-                        zipf.write(file_path, result['processed_name'])
-        
-        zip_buffer.seek(0)
-        zip_data = zip_buffer.getvalue()
-        zip_size = len(zip_data)
-        
-        if zip_size == 0:
-            schedule_session_cleanup(session_folder, delay=1)
-            return jsonify({'error': 'ZIP creado pero está vacío'}), 500
-      
+        entries = plan_zip_entries(entries, compression)
+    except Exception as e:
+        schedule_session_cleanup(session_folder, delay=1)
+        return jsonify({'error': f'Error creando ZIP: {str(e)}'}), 500
+    
+    stored = sum(1 for _, _, compress_type in entries if compress_type == zipfile.ZIP_STORED)
+    
+    results_by_path = {result['path']: result for result in successful_files}
+    etag = zip_archive_etag(entries, results_by_path)
+    
+    # El cliente ya tiene este ZIP
+    if request.if_none_match.contains(etag):
         schedule_session_cleanup(session_folder, delay=3)
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    # Reanudación: se sirve el mismo ZIP guardado en disco, con soporte de rangos.
+    # request.if_range siempre es un objeto (verdadero), así que se mira la cabecera
+    if request.range is not None or request.headers.get('If-Range'):
+        try:
+            zip_path = materialize_zip(session_folder, entries, etag)
+            response = serve_processed_file(zip_path, zip_filename, 'application/zip', session_folder, etag=etag)
+        except HTTPException:
+            raise
+        except Exception as e:
+            schedule_session_cleanup(session_folder, delay=DOWNLOAD_GRACE_TTL)
+            return jsonify({'error': f'Error creando ZIP: {str(e)}'}), 500
         
-        from flask import Response
-        response = Response(
-            zip_data,
-            mimetype='application/zip',
-            headers={
-                'Content-Disposition': f'attachment; filename="{zip_filename}"',
-                'Content-Type': 'application/zip',
-                'Content-Length': str(zip_size)
-            }
-        )
-        
-        print(f"Descarga ZIP iniciada: {zip_filename} ({zip_size//1024}KB) - {len(successful_files)} imágenes")
+        print(f"Descarga ZIP reanudada: {zip_filename} ({response.status_code}, "
+              f"{response.headers.get('Content-Range', 'completo')})")
         return response
     
-    except Exception as e:
-        schedule_session_cleanup(session_folder, delay=1)
-        return jsonify({'error': f'Error creando ZIP: {str(e)}'}), 500
+    # Si la descarga se corta, la sesión se conserva DOWNLOAD_GRACE_TTL para reanudarla
+    schedule_session_cleanup(session_folder, delay=DOWNLOAD_GRACE_TTL)
+    
+    def generate_zip():
+        """
+        ZIP en streaming; la sesión se limpia cuando el envío termina completo.
+        Mientras se envía, el plazo de caducidad se renueva para que una
+        descarga lenta no pierda la sesión a mitad.
+        """
+        sent = 0
+        renewed = time.monotonic()
+        try:
+            with storage_governor.in_use(session_folder):
+                for chunk in iter_zip_stream(entries):
+                    sent += len(chunk)
+                    yield chunk
+                    if time.monotonic() - renewed >= DOWNLOAD_RENEW_INTERVAL:
+                        schedule_session_cleanup(session_folder, delay=DOWNLOAD_GRACE_TTL)
+                        renewed = time.monotonic()
+            print(f"Descarga ZIP completada: {zip_filename} ({sent//1024}KB)")
+            schedule_session_cleanup(session_folder, delay=3)
+        except Exception as e:
+            print(f"✗ Error generando ZIP {zip_filename}: {str(e)}")
+            raise
+    
+    response = Response(
+        generate_zip(),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f'attachment; filename="{zip_filename}"',
+            'Accept-Ranges': 'bytes'
+        }
+    )
+    response.set_etag(etag)
+    
+    print(f"Descarga ZIP iniciada: {zip_filename} - {len(entries)} imágenes "
+          f"(compresión {compression}: {stored} sin comprimir, {len(entries) - stored} deflate)")
+    return response
 
 @app.route('/api/session/<session_id>', methods=['GET'])
 def get_session_info(session_id):
-    session_folder = os.path.join(UPLOAD_FOLDER, session_id)
-    metadata_path = os.path.join(session_folder, 'metadata.json')
+    try:
+        session = load_session(session_id)
+        if session is None:
+            return jsonify({'error': 'Sesión no encontrada'}), 404
+        
+        session['files'] = session_store.get_files(session_id)
+        if session['processed']:
+            session['results'] = session_store.get_results(session_id)
+        return jsonify(session)
+    except Exception as e:
+        return jsonify({'error': f'Error leyendo sesión: {str(e)}'}), 500
+
+def find_preview_file(filename):
+    """
+    Ruta de un archivo por su nombre, desde el índice. Si no está (sesiones
+    de antes de reiniciar o de otro proceso), se reindexan todas las sesiones,
+    pero como mucho una vez cada PREVIEW_RESCAN_INTERVAL: los nombres
+    desconocidos no recorren la carpeta en cada petición.
+    """
+    global _preview_rescanned_at
+    with _preview_index_lock:
+        path = _preview_index.get(filename)
+    if path and os.path.exists(path):
+        return path
     
-    if not os.path.exists(metadata_path):
-        return jsonify({'error': 'Sesión no encontrada'}), 404
+    now = time.monotonic()
+    with _preview_index_lock:
+        if _preview_rescanned_at is not None and now - _preview_rescanned_at < PREVIEW_RESCAN_INTERVAL:
+            return None
+        _preview_rescanned_at = now
+    
+    for session_dir in os.scandir(UPLOAD_FOLDER):
+        if session_dir.name.startswith('.') or not session_dir.is_dir():
+            continue
+        index_preview_files(session_dir.path, [entry.path for entry in os.scandir(session_dir.path)
+                                               if entry.is_file() and not entry.name.startswith('.')])
+    
+    with _preview_index_lock:
+        path = _preview_index.get(filename)
+    return path if path and os.path.exists(path) else None
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_MAX_BYTES)
+
+def preview_etag(found_path, size):
+    """
+    ETag de una miniatura: identifica el archivo (nombre, tamaño, fecha) y
+    el tamaño pedido, así que se calcula sin abrir la imagen.
+    """
+    stat = os.stat(found_path)
+    identity = f"{THUMBNAIL_VERSION}:{os.path.basename(found_path)}:{stat.st_size}:{stat.st_mtime_ns}:{size}"
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:32]
+
+def encode_thumbnail(img, image_format, size):
+    """Miniatura (bytes, mimetype) de una imagen; JPEG si el original es JPEG, si no PNG"""
+    thumbnail = make_thumbnail(img, size)
+    
+    img_buffer = io.BytesIO()
+    
+    format = image_format if image_format else 'PNG'
+    if format in ['JPEG', 'JPG']:
+        if thumbnail.mode in ('RGBA', 'LA'):
+            thumbnail = thumbnail.convert('RGB')
+        thumbnail.save(img_buffer, format='JPEG', quality=85, optimize=True)
+        mimetype = 'image/jpeg'
+    else:
+        thumbnail.save(img_buffer, format='PNG', optimize=True)
+        mimetype = 'image/png'
+    
+    return img_buffer.getvalue(), mimetype
+
+def render_thumbnail(found_path, size):
+    """Miniatura (bytes, mimetype) de un archivo"""
+    with Image.open(found_path) as img:
+        return encode_thumbnail(img, img.format, size)
+
+def render_preview(found_path):
+    """
+    Miniatura de un archivo de sesión (?size=, 300px por defecto).
+    Se sirve desde la caché de miniaturas con ETag y Cache-Control; si el
+    navegador ya la tiene responde 304 sin tocar la imagen.
+    """
+    try:
+        size = int(request.args.get('size', PREVIEW_SIZE))
+    except ValueError:
+        size = 0
+    if not PREVIEW_MIN_SIZE <= size <= PREVIEW_MAX_SIZE:
+        return jsonify({'error': f'size debe estar entre {PREVIEW_MIN_SIZE} y {PREVIEW_MAX_SIZE}'}), 400
     
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-        return jsonify(metadata)
+        etag = preview_etag(found_path, size)
+        
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            session_folder = os.path.dirname(found_path)
+            cached = thumbnail_cache.get(etag, session_folder)
+            if cached is None:
+                cached = render_thumbnail(found_path, size)
+                thumbnail_cache.put(etag, session_folder, *cached)
+            data, mimetype = cached
+            response = Response(data, mimetype=mimetype)
+            
     except Exception as e:
-        return jsonify({'error': f'Error leyendo sesión: {str(e)}'}), 500
+        return jsonify({'error': f'Error procesando imagen: {str(e)}'}), 500
+    
+    response.set_etag(etag)
+    response.cache_control.public = True
+    if request.args.get('v'):
+        # URL versionada por contenido (ver build_preview_url)
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = PREVIEW_MAX_AGE
+    return response.make_conditional(request)
 
 @app.route('/api/preview/<filename>', methods=['GET'])
 def get_image_preview(filename):
-    found_path = None
-    
     try:
-        for session_dir in os.listdir(UPLOAD_FOLDER):
-            session_path = os.path.join(UPLOAD_FOLDER, session_dir)
-            if os.path.isdir(session_path):
-                for file in os.listdir(session_path):
-                    if file == filename:
-                        found_path = os.path.join(session_path, file)
-                        break
-                if found_path:
-                    break
+        found_path = find_preview_file(filename)
     except Exception as e:
         return jsonify({'error': f'Error buscando archivo: {str(e)}'}), 500
     
-    if not found_path or not os.path.exists(found_path):
+    if not found_path:
         return jsonify({'error': 'Archivo no encontrado'}), 404
     
-    try:
-        with Image.open(found_path) as img:
-            thumbnail = img.copy()
-            thumbnail.thumbnail((300, 300), Image.Resampling.LANCZOS)
-            
-            img_buffer = io.BytesIO()
-            
-            format = img.format if img.format else 'PNG'
-            if format in ['JPEG', 'JPG']:
-                if thumbnail.mode in ('RGBA', 'LA'):
-                    thumbnail = thumbnail.convert('RGB')
-                thumbnail.save(img_buffer, format='JPEG', quality=85, optimize=True)
-                mimetype = 'image/jpeg'
-            else:
-                thumbnail.save(img_buffer, format='PNG', optimize=True)
-                mimetype = 'image/png'
-            
-            img_buffer.seek(0)
-            
-            return send_file(
-                img_buffer,
-                mimetype=mimetype,
-                as_attachment=False
-            )
-            
-    except Exception as e:
-        return jsonify({'error': f'Error procesando imagen: {str(e)}'}), 500
+    return render_preview(found_path)
 
-@app.route('/api/dimensions/<session_id>', methods=['GET'])
-def get_image_dimensions(session_id):
-    session_folder = os.path.join(UPLOAD_FOLDER, session_id)
-    metadata_path = os.path.join(session_folder, 'metadata.json')
+@app.route('/api/preview/<session_id>/<filename>', methods=['GET'])
+def get_session_image_preview(session_id, filename):
+    """Vista previa de un archivo de una sesión concreta, sin búsquedas"""
+    if session_id.startswith('.') or filename.startswith('.'):
+        return jsonify({'error': 'Archivo no encontrado'}), 404
     
-    if not os.path.exists(metadata_path):
-        return jsonify({'error': 'Sesión no encontrada'}), 404
+    found_path = os.path.join(UPLOAD_FOLDER, session_id, filename)
+    if not os.path.isfile(found_path):
+        return jsonify({'error': 'Archivo no encontrado'}), 404
     
+    return render_preview(found_path)
+
+@app.route('/api/dimensions/<session_id>', methods=['GET'])
+def get_image_dimensions(session_id):
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
+        session = load_session(session_id)
+        files = session_store.get_files(session_id, limit=1) if session else []
     except Exception as e:
         return jsonify({'error': f'Error leyendo sesión: {str(e)}'}), 500
     
-    files = metadata.get('files', [])
+    if session is None:
+        return jsonify({'error': 'Sesión no encontrada'}), 404
+    
     if not files:
         return jsonify({'error': 'No hay archivos en la sesión'}), 404
     
@@ -923,7 +2208,7 @@ def manual_cleanup(session_id):
         return jsonify({'error': 'Sesión no encontrada'}), 404
     
     try:
-        shutil.rmtree(session_folder)
+        remove_session_folder(session_folder)
         return jsonify({
             'success': True,
             'message': f'Sesión {session_id} eliminada correctamente'
@@ -941,8 +2226,8 @@ def cleanup_all_sessions():
         cleaned = 0
         for session_dir in os.listdir(UPLOAD_FOLDER):
             session_path = os.path.join(UPLOAD_FOLDER, session_dir)
-            if os.path.isdir(session_path):
-                shutil.rmtree(session_path)
+            if not session_dir.startswith('.') and os.path.isdir(session_path):
+                remove_session_folder(session_path)
                 cleaned += 1
         
         return jsonify({
@@ -963,6 +2248,12 @@ if __name__ == '__main__':
     print(f" Formatos soportados: {', '.join(sorted(ALLOWED_EXTENSIONS))}")
     print(f" Servidor: http://localhost:5000")
     print(f" Health check: http://localhost:5000/api/health")
+    print(f" Liveness/readiness: http://localhost:5000/livez, http://localhost:5000/readyz")
     print("=" * 70)
     
+    # Con el recargador, solo el proceso hijo (WERKZEUG_RUN_MAIN) sirve peticiones;
+    # sin él, los servicios arrancan con la primera petición
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
+    
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,93 @@
+"""
+Detección de las capacidades del servidor para /api/health.
+
+Las herramientas externas (oxipng, pngquant), los modelos rembg descargados
+y los códecs de Pillow se comprueban al arrancar y luego cada cierto
+tiempo en un hilo, así que consultar el estado nunca lanza procesos.
+"""
+import os
+import shutil
+import subprocess
+import threading
+import time
+from datetime import datetime
+
+import PIL
+from PIL import Image, features
+
+def command_version(command):
+    """Primera línea de `command --version`, o None si no está instalado"""
+    if shutil.which(command) is None:
+        return None
+    try:
+        result = subprocess.run([command, '--version'], capture_output=True, text=True, timeout=5)
+    except Exception:
+        return None
+    if result.returncode != 0:
+        return None
+    lines = (result.stdout or result.stderr).strip().splitlines()
+    return lines[0] if lines else command
+
+def rembg_models():
+    """Modelos rembg ya descargados (los .onnx de U2NET_HOME)"""
+    folder = os.environ.get('U2NET_HOME', os.path.join(os.path.expanduser('~'), '.u2net'))
+    try:
+        return sorted(name[:-len('.onnx')] for name in os.listdir(folder) if name.endswith('.onnx'))
+    except OSError:
+        return []
+
+def pillow_info():
+    """Versión de Pillow y formatos que puede leer en este servidor"""
+    extensions = Image.registered_extensions()
+    return {
+        'version': PIL.__version__,
+        'codecs': {
+            'jpeg': features.check_codec('jpg'),
+            'png': features.check_codec('zlib'),
+            'webp': features.check_module('webp'),
+            'avif': '.avif' in extensions,
+            'heif': '.heic' in extensions,
+            'tiff': features.check_codec('libtiff')
+        }
+    }
+
+class CapabilityProbe:
+    def __init__(self, probe, interval):
+        """`probe()` devuelve el dict de capacidades; se repite cada `interval` segundos"""
+        self.probe = probe
+        self.interval = interval
+        self._capabilities = None
+        self._lock = threading.Lock()
+        self._started = False
+
+    def refresh(self):
+        started = time.monotonic()
+        capabilities = self.probe()
+        capabilities['checked_at'] = datetime.now().isoformat()
+        capabilities['probe_ms'] = round((time.monotonic() - started) * 1000, 1)
+        with self._lock:
+            self._capabilities = capabilities
+        return capabilities
+
+    def get(self):
+        """Última detección, o {'pending': True} si la primera aún no ha terminado"""
+        with self._lock:
+            capabilities = self._capabilities
+        return capabilities if capabilities is not None else {'pending': True}
+
+    def start(self):
+        """Detectar en segundo plano ya y después cada `interval` segundos"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        def loop():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"✗ Error comprobando capacidades: {str(e)}")
+                time.sleep(self.interval)
+
+        threading.Thread(target=loop, name='capability-probe', daemon=True).start()
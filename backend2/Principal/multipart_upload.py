@@ -0,0 +1,156 @@
+"""
+Recepción de subidas multipart en streaming.
+
+El cuerpo de la petición se lee por bloques con el decodificador de
+Werkzeug y cada archivo se escribe directamente en la carpeta de la
+sesión, sin archivo temporal intermedio ni segunda copia. El SHA-256 y la
+firma del formato se calculan mientras llegan los datos; un archivo
+rechazado se descarta sin escribir nada en disco.
+"""
+import hashlib
+import os
+import uuid
+
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, Field, File, NeedData
+from werkzeug.utils import secure_filename
+
+CHUNK_SIZE = 64 * 1024
+
+# Bytes del inicio de cada archivo que se miran para reconocer el formato
+HEAD_SIZE = 16
+
+# Firmas por extensión; las extensiones sin entrada (p. ej. 'raw') no se comprueban
+FILE_SIGNATURES = {
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'gif': (b'GIF87a', b'GIF89a'),
+    'bmp': (b'BM',),
+    'tiff': (b'II*\x00', b'MM\x00*'),
+    'tif': (b'II*\x00', b'MM\x00*'),
+    'psd': (b'8BPS',),
+    'zip': (b'PK\x03\x04', b'PK\x05\x06'),
+}
+
+def signature_matches(extension, head):
+    """True si los primeros bytes corresponden al formato de la extensión"""
+    if extension == 'webp':
+        return head[:4] == b'RIFF' and head[8:12] == b'WEBP'
+    if extension == 'heic':
+        return head[4:8] == b'ftyp'
+    signatures = FILE_SIGNATURES.get(extension)
+    if signatures is None:
+        return True
+    return head.startswith(signatures)
+
+class _IncomingFile:
+    """Archivo en recepción: retiene la cabecera hasta validar la firma"""
+
+    def __init__(self, original_name, destination):
+        self.original_name = original_name
+        self.filename = f"{uuid.uuid4()}_{secure_filename(original_name)}"
+        self.path = os.path.join(destination, self.filename)
+        self.extension = original_name.rsplit('.', 1)[1].lower()
+        self.head = b''
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.output = None
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        self.output.write(data)
+
+    def receive(self, data, last):
+        """
+        Añadir datos recibidos. Devuelve False si la firma no coincide
+        con la extensión (el archivo se descarta sin haberse escrito).
+        """
+        if self.output is not None:
+            self.write(data)
+            return True
+
+        self.head += data
+        if len(self.head) < HEAD_SIZE and not last:
+            return True
+        if not signature_matches(self.extension, self.head):
+            return False
+
+        self.output = open(self.path, 'wb')
+        self.write(self.head)
+        self.head = b''
+        return True
+
+    def finish(self):
+        if self.output is None:
+            self.output = open(self.path, 'wb')
+        self.output.close()
+        return {
+            'filename': self.filename,
+            'original_name': secure_filename(self.original_name),
+            'path': self.path,
+            'size': self.size,
+            'sha256': self.digest.hexdigest()
+        }
+
+    def discard(self):
+        if self.output is not None:
+            self.output.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+def receive_multipart_files(stream, boundary, destination, is_allowed, field_name='files', max_parts=None):
+    """
+    Leer un cuerpo multipart y guardar los archivos del campo `field_name`
+    en `destination`. `is_allowed(nombre)` se consulta con las cabeceras de
+    cada parte, antes de recibir su contenido.
+    Devuelve (guardados, errores, partes): dicts con filename, original_name,
+    path, size y sha256; mensajes de archivos rechazados; y el número de
+    partes con nombre de archivo.
+    """
+    decoder = MultipartDecoder(boundary, max_parts=max_parts)
+    saved = []
+    errors = []
+    file_parts = 0
+    current = None
+    skipping = True
+
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File) and event.name == field_name and event.filename:
+                    file_parts += 1
+                    if is_allowed(event.filename):
+                        current = _IncomingFile(event.filename, destination)
+                        skipping = False
+                    else:
+                        errors.append(f"Archivo no permitido: {event.filename}")
+                        skipping = True
+                elif isinstance(event, (File, Field)):
+                    skipping = True
+                elif isinstance(event, Data) and not skipping:
+                    if not current.receive(event.data, not event.more_data):
+                        errors.append(f"El contenido no corresponde al formato: {current.original_name}")
+                        current = None
+                        skipping = True
+                    elif not event.more_data:
+                        saved.append(current.finish())
+                        current = None
+                        skipping = True
+                event = decoder.next_event()
+
+            if not chunk or isinstance(event, Epilogue):
+                break
+    except Exception:
+        if current is not None:
+            current.discard()
+        for info in saved:
+            if os.path.exists(info['path']):
+                os.remove(info['path'])
+        raise
+
+    return saved, errors, file_parts
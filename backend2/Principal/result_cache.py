@@ -0,0 +1,209 @@
+"""
+Caché en disco de resultados de procesamiento.
+
+Cada entrada se identifica por el SHA-256 de la imagen de entrada y las
+opciones de procesamiento normalizadas (incluida la versión del
+pipeline), y guarda el archivo resultante junto a un JSON con los datos
+del resultado. Las escrituras son atómicas (archivo temporal + rename),
+así que los workers de varios procesos pueden leer y escribir a la vez.
+
+La caché tiene un tamaño máximo; al superarlo se eliminan las entradas
+usadas hace más tiempo (la fecha de modificación del JSON se actualiza en
+cada acierto). El proceso principal lleva un índice en memoria con el
+tamaño y el último uso de cada entrada, cargado una sola vez al arrancar,
+así que consultar el estado o recortar no recorre la carpeta. Es
+independiente de la limpieza de sesiones.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+class ResultCache:
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        # Índice en memoria {clave: [último uso, bytes]} y total, cargados una vez al arrancar
+        self._index = {}
+        self._bytes = 0
+        self._loaded = threading.Event()
+        self._evict_requested = threading.Event()
+        self._started = False
+
+    def key(self, input_hash, options):
+        """Clave de una imagen (SHA-256 de su contenido) con unas opciones normalizadas"""
+        options_json = json.dumps(options, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(f"{input_hash}\0{options_json}".encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.folder, key[:2], key)
+        return base + '.out', base + '.json'
+
+    def get(self, key):
+        """(ruta del archivo, datos) de una entrada, o None si no existe"""
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if not os.path.exists(data_path):
+                return None
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            return None
+        return data_path, meta
+
+    def put(self, key, source_path, meta):
+        """Guardar una copia de `source_path` y sus datos"""
+        data_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        suffix = f".{uuid.uuid4().hex}.tmp"
+
+        try:
+            shutil.copyfile(source_path, data_path + suffix)
+            os.replace(data_path + suffix, data_path)
+            with open(meta_path + suffix, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(meta_path + suffix, meta_path)
+        finally:
+            for tmp_path in (data_path + suffix, meta_path + suffix):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def record(self, hit, size=0, key=None):
+        """
+        Contabilizar un acierto (con los bytes reutilizados) o un fallo. Con
+        `key`, actualizar el índice en memoria: en un acierto se marca como
+        usada; en un fallo se añade la entrada que acaba de guardar el worker.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += size
+            else:
+                self.misses += 1
+        if key is not None and self._started:
+            if hit:
+                with self._lock:
+                    if key in self._index:
+                        self._index[key][0] = time.time()
+            else:
+                self._track(key)
+
+    def _track(self, key):
+        """Añadir (o actualizar) una entrada del índice mirando sus dos archivos"""
+        data_path, meta_path = self._paths(key)
+        try:
+            meta_stat = os.stat(meta_path)
+            size = meta_stat.st_size + os.path.getsize(data_path)
+        except OSError:
+            return
+        with self._lock:
+            previous = self._index.get(key)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._index[key] = [meta_stat.st_mtime, size]
+            self._bytes += size
+        if self._bytes > self.max_bytes:
+            self._evict_requested.set()
+
+    def _scan(self):
+        """Entradas en disco como {clave: [último uso, bytes]}"""
+        entries = {}
+        if not os.path.isdir(self.folder):
+            return entries
+        for shard in os.scandir(self.folder):
+            if not shard.is_dir():
+                continue
+            for item in os.scandir(shard.path):
+                if not item.name.endswith('.json'):
+                    continue
+                data_path = item.path[:-len('.json')] + '.out'
+                try:
+                    meta_stat = item.stat()
+                    size = meta_stat.st_size + os.path.getsize(data_path)
+                except OSError:
+                    continue
+                entries[item.name[:-len('.json')]] = [meta_stat.st_mtime, size]
+        return entries
+
+    def start(self):
+        """
+        Cargar el índice (un único recorrido de la carpeta) y atender los
+        recortes en un hilo aparte, fuera de las peticiones. Solo en el
+        proceso principal; los workers solo leen y escriben entradas.
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        def loop():
+            entries = self._scan()
+            with self._lock:
+                # Las entradas registradas durante el recorrido ya tienen datos más recientes
+                entries.update(self._index)
+                self._index = entries
+                self._bytes = sum(size for _, size in entries.values())
+            self._loaded.set()
+            while True:
+                if self._bytes > self.max_bytes:
+                    try:
+                        removed, freed = self.evict()
+                        if removed:
+                            print(f"🧹 Caché de resultados: {removed} entradas eliminadas ({freed//1024}KB)")
+                    except Exception as e:
+                        print(f"Error recortando caché de resultados: {str(e)}")
+                self._evict_requested.wait()
+                self._evict_requested.clear()
+
+        threading.Thread(target=loop, name='result-cache', daemon=True).start()
+
+    def request_evict(self):
+        """Pedir un recorte en segundo plano (no hace nada si la caché cabe)"""
+        self._evict_requested.set()
+
+    def evict(self):
+        """Eliminar las entradas menos usadas hasta quedar bajo max_bytes. Devuelve (entradas, bytes)"""
+        with self._lock:
+            if self._bytes <= self.max_bytes:
+                return 0, 0
+            candidates = sorted((last_used, key, size) for key, (last_used, size) in self._index.items())
+
+        removed = 0
+        freed = 0
+        for _, key, size in candidates:
+            if self._bytes <= self.max_bytes:
+                break
+            for path in reversed(self._paths(key)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            with self._lock:
+                if self._index.pop(key, None) is not None:
+                    self._bytes -= size
+            freed += size
+            removed += 1
+
+        return removed, freed
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'indexed': self._loaded.is_set(),
+                'entries': len(self._index),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'bytes_saved': self.bytes_saved
+            }
@@ -0,0 +1,125 @@
+"""
+Caducidad de sesiones con un único planificador.
+
+Las caducidades pendientes se guardan en un min-heap de (plazo, sesión) que
+atiende un solo hilo; volver a programar una sesión reemplaza su plazo
+anterior (la entrada vieja se ignora al salir del heap). Al caducar, la
+carpeta se renombra a una papelera dentro de la misma carpeta de subidas,
+que es inmediato, y otro hilo la borra después, de modo que shutil.rmtree
+nunca se ejecuta en una petición.
+"""
+import heapq
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+class SessionExpiryScheduler:
+    def __init__(self, trash_folder, on_expire):
+        """`on_expire(clave)` se llama en el hilo del planificador al vencer el plazo"""
+        self.trash_folder = trash_folder
+        self.on_expire = on_expire
+        self.expired = 0
+        self.trash_bytes = 0
+        self._heap = []
+        self._deadlines = {}
+        self._condition = threading.Condition()
+        self._trash_queue = queue.Queue()
+        self._started = False
+
+    def start(self):
+        """Arrancar los hilos del planificador y del borrado; vacía lo que quedó en la papelera"""
+        with self._condition:
+            if self._started:
+                return
+            self._started = True
+
+        os.makedirs(self.trash_folder, exist_ok=True)
+        for name in os.listdir(self.trash_folder):
+            self._trash_queue.put((os.path.join(self.trash_folder, name), 0))
+
+        threading.Thread(target=self._run, name='session-expiry', daemon=True).start()
+        threading.Thread(target=self._delete_loop, name='session-trash', daemon=True).start()
+
+    def schedule(self, key, delay):
+        """Programar la caducidad de `key` dentro de `delay` segundos (manda la última llamada)"""
+        deadline = time.monotonic() + delay
+        with self._condition:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, key))
+            # Con muchas reprogramaciones, rehacer el heap sin las entradas reemplazadas
+            if len(self._heap) > 2 * len(self._deadlines) + 64:
+                self._heap = [(d, k) for k, d in self._deadlines.items()]
+                heapq.heapify(self._heap)
+            if self._heap[0] == (deadline, key):
+                self._condition.notify()
+
+    def cancel(self, key):
+        with self._condition:
+            self._deadlines.pop(key, None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    # Descartar entradas reemplazadas o canceladas
+                    while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._condition.wait(wait)
+
+                _, key = heapq.heappop(self._heap)
+                del self._deadlines[key]
+                self.expired += 1
+
+            try:
+                self.on_expire(key)
+            except Exception as e:
+                print(f"✗ Error caducando sesión {os.path.basename(key)}: {str(e)}")
+
+    def trash(self, path, size=0):
+        """
+        Mover `path` a la papelera y encolar su borrado. False si ya no existe.
+        `size` (bytes) se cuenta en trash_bytes hasta que se borra.
+        """
+        destination = os.path.join(self.trash_folder, f"{os.path.basename(path)}.{uuid.uuid4().hex}")
+        os.makedirs(self.trash_folder, exist_ok=True)
+        try:
+            os.rename(path, destination)
+        except FileNotFoundError:
+            return False
+        with self._condition:
+            self.trash_bytes += size
+        self._trash_queue.put((destination, size))
+        return True
+
+    def _delete_loop(self):
+        while True:
+            path, size = self._trash_queue.get()
+            try:
+                shutil.rmtree(path, ignore_errors=True)
+            finally:
+                with self._condition:
+                    self.trash_bytes -= size
+                self._trash_queue.task_done()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._condition:
+            next_deadline = min(self._deadlines.values(), default=None)
+            return {
+                'pending': len(self._deadlines),
+                'heap_entries': len(self._heap),
+                'due_within_60s': sum(1 for deadline in self._deadlines.values() if deadline - now <= 60),
+                'next_in_seconds': round(max(next_deadline - now, 0), 1) if next_deadline is not None else None,
+                'expired': self.expired,
+                'trash_pending': self._trash_queue.unfinished_tasks,
+                'trash_bytes': self.trash_bytes
+            }
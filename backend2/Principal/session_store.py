@@ -0,0 +1,189 @@
+"""
+Almacén de sesiones en SQLite.
+
+Sustituye al metadata.json de cada sesión: los datos de la sesión, sus
+archivos y los resultados del procesamiento van en tablas separadas, así
+que cada resultado se guarda con una actualización de una sola fila en
+lugar de reescribir el documento entero. La base de datos está en modo
+WAL, de modo que las lecturas no esperan a las escrituras, y cada hilo
+usa su propia conexión.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    upload_type TEXT,
+    stats TEXT,
+    errors TEXT,
+    processed INTEGER NOT NULL DEFAULT 0,
+    processed_at TEXT,
+    processing_options TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions (created_at);
+
+CREATE TABLE IF NOT EXISTS files (
+    session_id TEXT NOT NULL REFERENCES sessions (session_id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (session_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS results (
+    session_id TEXT NOT NULL REFERENCES sessions (session_id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    success INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (session_id, position)
+);
+"""
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+class SessionStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def _connection(self):
+        """Conexión del hilo actual (se abre, y se crea el esquema, al primer uso)"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection
+
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('PRAGMA foreign_keys=ON')
+
+        with self._schema_lock:
+            if not self._schema_ready:
+                connection.executescript(SCHEMA)
+                self._schema_ready = True
+
+        self._local.connection = connection
+        return connection
+
+    def create_session(self, session_id, created_at, files, errors=None, upload_type=None, stats=None):
+        """Registrar una sesión nueva con sus archivos"""
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT INTO sessions (session_id, created_at, upload_type, stats, errors) VALUES (?, ?, ?, ?, ?)',
+                (session_id, created_at, upload_type, _dumps(stats or {}), _dumps(errors or []))
+            )
+            connection.executemany(
+                'INSERT INTO files (session_id, position, data) VALUES (?, ?, ?)',
+                [(session_id, position, _dumps(file_info)) for position, file_info in enumerate(files)]
+            )
+
+    def import_metadata(self, metadata):
+        """Cargar un metadata.json de versiones anteriores (si la sesión no existe ya)"""
+        session_id = metadata['session_id']
+        connection = self._connection()
+        with connection:
+            inserted = connection.execute(
+                'INSERT OR IGNORE INTO sessions (session_id, created_at, upload_type, stats, errors, '
+                'processed, processed_at, processing_options) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (session_id, metadata.get('created_at', ''), metadata.get('upload_type'),
+                 _dumps(metadata.get('stats', {})), _dumps(metadata.get('errors', [])),
+                 int(bool(metadata.get('processed', False))), metadata.get('processed_at'),
+                 _dumps(metadata['processing_options']) if 'processing_options' in metadata else None)
+            ).rowcount
+            if not inserted:
+                return
+            connection.executemany(
+                'INSERT INTO files (session_id, position, data) VALUES (?, ?, ?)',
+                [(session_id, position, _dumps(file_info))
+                 for position, file_info in enumerate(metadata.get('files', []))]
+            )
+            connection.executemany(
+                'INSERT INTO results (session_id, position, success, data) VALUES (?, ?, ?, ?)',
+                [(session_id, position, int(bool(result.get('success'))), _dumps(result))
+                 for position, result in enumerate(metadata.get('results', [])) if result is not None]
+            )
+
+    def get_session(self, session_id):
+        """Datos generales de la sesión (sin archivos ni resultados), o None si no existe"""
+        row = self._connection().execute(
+            'SELECT * FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        session = {
+            'session_id': row['session_id'],
+            'created_at': row['created_at'],
+            'errors': json.loads(row['errors'] or '[]'),
+            'processed': bool(row['processed']),
+            'upload_type': row['upload_type'],
+            'stats': json.loads(row['stats'] or '{}')
+        }
+        if row['processed_at']:
+            session['processed_at'] = row['processed_at']
+        if row['processing_options']:
+            session['processing_options'] = json.loads(row['processing_options'])
+        return session
+
+    def get_files(self, session_id, limit=None):
+        """Archivos de la sesión en orden de subida"""
+        query = 'SELECT data FROM files WHERE session_id = ? ORDER BY position'
+        params = (session_id,)
+        if limit is not None:
+            query += ' LIMIT ?'
+            params += (limit,)
+        return [json.loads(row['data']) for row in self._connection().execute(query, params)]
+
+    def get_results(self, session_id, successful_only=False):
+        """Resultados guardados, en el orden de los archivos"""
+        query = 'SELECT data FROM results WHERE session_id = ?'
+        if successful_only:
+            query += ' AND success = 1'
+        query += ' ORDER BY position'
+        return [json.loads(row['data']) for row in self._connection().execute(query, (session_id,))]
+
+    def save_result(self, session_id, position, result):
+        """Guardar (o reemplazar) el resultado de un archivo"""
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO results (session_id, position, success, data) VALUES (?, ?, ?, ?)',
+                (session_id, position, int(bool(result.get('success'))), _dumps(result))
+            )
+
+    def mark_processed(self, session_id, processed_at, options):
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'UPDATE sessions SET processed = 1, processed_at = ?, processing_options = ? WHERE session_id = ?',
+                (processed_at, _dumps(options), session_id)
+            )
+
+    def delete_session(self, session_id):
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+
+    def delete_sessions_except(self, session_ids):
+        """Borrar las sesiones que no están en `session_ids`. Devuelve cuántas"""
+        session_ids = set(session_ids)
+        connection = self._connection()
+        with connection:
+            missing = [(row['session_id'],) for row in connection.execute('SELECT session_id FROM sessions')
+                       if row['session_id'] not in session_ids]
+            connection.executemany('DELETE FROM sessions WHERE session_id = ?', missing)
+        return len(missing)
+
+    def count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
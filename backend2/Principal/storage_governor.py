@@ -0,0 +1,184 @@
+"""
+Control del espacio en disco de la carpeta de subidas.
+
+Lleva la cuenta de los bytes y el último uso de cada sesión. Cuando el uso
+del disco (más lo que está por llegar) supera la marca alta, elimina las
+sesiones terminadas o abandonadas usadas hace más tiempo hasta bajar de la
+marca baja. No se eliminan las sesiones en uso ni las recién subidas que
+aún no se han procesado (dentro del margen `unprocessed_grace`). Si ni así cabe, la subida se rechaza: con sesiones en uso
+que liberarán espacio al terminar, para reintentar más tarde; si no, por
+falta de espacio.
+"""
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+def folder_size(path):
+    """Bytes de todos los archivos bajo `path`"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class StorageGovernor:
+    def __init__(self, folder, high_watermark, low_watermark, evict, pending_bytes=lambda: 0,
+                 unprocessed_grace=0):
+        """
+        `high_watermark` y `low_watermark` son fracciones del disco ocupado.
+        `evict(clave)` elimina una sesión; `pending_bytes()` son los bytes ya
+        eliminados que aún ocupan disco (p. ej. en la papelera).
+        `unprocessed_grace` son los segundos que se respeta una sesión sin procesar.
+        """
+        self.folder = folder
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.evict = evict
+        self.pending_bytes = pending_bytes
+        self.unprocessed_grace = unprocessed_grace
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self.rejected = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+
+    def _entry(self, key):
+        """Entrada de una sesión, creada si no existe (llamar con _lock)"""
+        now = time.time()
+        return self._sessions.setdefault(key, {'bytes': 0, 'last_used': now, 'created': now,
+                                               'processed': False, 'in_use': 0})
+
+    def track(self, key, size=None, last_used=None, processed=None):
+        """
+        Registrar (o actualizar) el tamaño de una sesión; sin `size`, se mide
+        la carpeta. `processed` indica si ya se procesó alguna vez.
+        """
+        if size is None:
+            size = folder_size(key)
+        with self._lock:
+            entry = self._entry(key)
+            entry['bytes'] = size
+            entry['last_used'] = last_used or time.time()
+            if last_used:
+                entry['created'] = min(entry['created'], last_used)
+            if processed is not None:
+                entry['processed'] = processed
+
+    def touch(self, key):
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is not None:
+                entry['last_used'] = time.time()
+
+    def forget(self, key):
+        """Dejar de seguir una sesión. Devuelve los bytes que tenía registrados"""
+        with self._lock:
+            entry = self._sessions.pop(key, None)
+        return entry['bytes'] if entry else 0
+
+    def acquire(self, key):
+        """Marcar la sesión en uso: no se elimina por falta de espacio hasta release()"""
+        with self._lock:
+            entry = self._entry(key)
+            entry['in_use'] += 1
+            entry['last_used'] = time.time()
+        return entry
+
+    def release(self, key, entry=None):
+        with self._lock:
+            entry = entry or self._sessions.get(key)
+            if entry is not None and entry['in_use'] > 0:
+                entry['in_use'] -= 1
+                entry['last_used'] = time.time()
+
+    @contextmanager
+    def in_use(self, key):
+        """Mientras dure el bloque la sesión no se elimina por falta de espacio"""
+        entry = self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release(key, entry)
+
+    def _evictable(self, entry, now):
+        """Terminada o abandonada: ni en uso ni recién subida sin procesar"""
+        if entry['in_use']:
+            return False
+        return entry['processed'] or now - entry['created'] >= self.unprocessed_grace
+
+    def disk_usage(self):
+        """(bytes ocupados, bytes totales), descontando lo pendiente de borrar"""
+        usage = shutil.disk_usage(self.folder)
+        return max(usage.used - self.pending_bytes(), 0), usage.total
+
+    def ensure_space(self, incoming=0, reject=True):
+        """
+        Hacer sitio para `incoming` bytes. Devuelve None si caben, 'busy' si
+        solo cabrán cuando terminen las sesiones en uso o recién subidas y
+        'full' si no caben.
+        Con `reject=False` solo libera espacio y no cuenta rechazos.
+        """
+        with self._evict_lock:
+            used, total = self.disk_usage()
+            if used + incoming <= total * self.high_watermark:
+                return None
+
+            needed = used + incoming - total * self.low_watermark
+            now = time.time()
+            with self._lock:
+                candidates = sorted((entry['last_used'], key, entry['bytes'])
+                                    for key, entry in self._sessions.items() if self._evictable(entry, now))
+                busy_bytes = sum(entry['bytes'] for entry in self._sessions.values()
+                                 if not self._evictable(entry, now))
+
+            freed = 0
+            evicted = 0
+            for _, key, size in candidates:
+                if freed >= needed:
+                    break
+                try:
+                    self.evict(key)
+                except Exception as e:
+                    print(f"✗ Error liberando espacio ({os.path.basename(key)}): {str(e)}")
+                    continue
+                self.forget(key)
+                freed += size
+                evicted += 1
+                self.evicted += 1
+                self.evicted_bytes += size
+
+            if evicted:
+                print(f"🧹 Disco al {used / total:.0%}: {evicted} sesiones eliminadas ({freed // (1024 * 1024)}MB)")
+
+            if used - freed + incoming <= total * self.high_watermark:
+                return None
+            if not reject:
+                return 'full'
+            self.rejected += 1
+            if busy_bytes and used - freed - busy_bytes + incoming <= total * self.high_watermark:
+                return 'busy'
+            return 'full'
+
+    def stats(self):
+        used, total = self.disk_usage()
+        with self._lock:
+            return {
+                'disk_used': used,
+                'disk_total': total,
+                'disk_free': max(total - used, 0),
+                'disk_used_ratio': round(used / total, 3) if total else None,
+                'high_watermark': self.high_watermark,
+                'low_watermark': self.low_watermark,
+                'sessions': len(self._sessions),
+                'session_bytes': sum(entry['bytes'] for entry in self._sessions.values()),
+                'sessions_in_use': sum(1 for entry in self._sessions.values() if entry['in_use']),
+                'evicted': self.evicted,
+                'evicted_bytes': self.evicted_bytes,
+                'rejected': self.rejected
+            }
@@ -0,0 +1,99 @@
+"""
+Caché de miniaturas para las vistas previas.
+
+Dos niveles: memoria (LRU limitado por bytes, compartido por todas las
+sesiones) y disco, en una carpeta oculta dentro de cada sesión, que se
+borra junto con ella. Así cada imagen se decodifica una vez por sesión y
+tamaño, aunque el proceso se reinicie o la memoria se llene.
+"""
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+THUMBS_DIR = '.thumbs'
+
+MIMETYPES = {
+    '.jpg': 'image/jpeg',
+    '.png': 'image/png',
+}
+EXTENSIONS = {mimetype: extension for extension, mimetype in MIMETYPES.items()}
+
+class ThumbnailCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _remember(self, key, data, mimetype):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key)[0])
+            if len(data) > self.max_bytes:
+                return
+            self._entries[key] = (data, mimetype)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, (old_data, _) = self._entries.popitem(last=False)
+                self._bytes -= len(old_data)
+
+    def get(self, key, session_folder):
+        """(bytes, mimetype) de la miniatura, de memoria o de disco; None si no existe"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        for extension, mimetype in MIMETYPES.items():
+            path = os.path.join(session_folder, THUMBS_DIR, key + extension)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            self._remember(key, data, mimetype)
+            with self._lock:
+                self.disk_hits += 1
+            return data, mimetype
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, session_folder, data, mimetype, remember=True):
+        """
+        Guardar una miniatura en la carpeta de la sesión y, con `remember`,
+        también en memoria (los workers del pool solo la escriben en disco).
+        """
+        if remember:
+            self._remember(key, data, mimetype)
+
+        folder = os.path.join(session_folder, THUMBS_DIR)
+        path = os.path.join(folder, key + EXTENSIONS[mimetype])
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(folder, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # La sesión pudo borrarse mientras tanto; la copia en memoria basta
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,167 @@
+"""
+Escritura de archivos ZIP en streaming.
+
+El ZIP se genera por partes mientras se leen los archivos, sin tener el
+archivo completo en memoria. Como la salida no es posicionable, zipfile
+usa descriptores de datos tras cada entrada comprimida y Zip64 cuando hace
+falta.
+
+Cada entrada se guarda sin comprimir (ZIP_STORED) o con deflate según lo
+que convenga: comprimir de nuevo un PNG o JPEG gasta CPU sin ganar nada.
+Las entradas sin comprimir llevan el CRC y el tamaño en su cabecera local
+(se leen antes de escribirlas), porque los lectores en streaming como
+ZipInputStream de Java no aceptan entradas STORED con descriptor de datos.
+"""
+import os
+import zipfile
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+COMPRESSION_MODES = ('store', 'auto', 'deflate')
+
+# Formatos que ya vienen comprimidos (PNG, JPEG, GIF, WebP, ZIP)
+COMPRESSED_SIGNATURES = (
+    b'\x89PNG\r\n\x1a\n',
+    b'\xff\xd8\xff',
+    b'GIF87a',
+    b'GIF89a',
+    b'RIFF',
+    b'PK\x03\x04',
+)
+
+# Versión del formato de los ZIP generados: cambia los bytes de salida, así
+# que forma parte del ETag de las descargas
+FORMAT_VERSION = 2
+
+# Muestra para medir la compresibilidad y ahorro mínimo para usar deflate
+SAMPLE_SIZE = 64 * 1024
+MIN_DEFLATE_SAVING = 0.05
+
+class ZipStreamBuffer:
+    """Destino no posicionable para ZipFile: guarda lo escrito hasta que se recoge"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Devolver y descartar lo escrito desde la última llamada"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def choose_compression(path, mode='auto'):
+    """
+    Compresión para una entrada: ZIP_STORED si no vale la pena comprimirla.
+    En modo 'auto' se reconoce la firma de formatos ya comprimidos y, si no,
+    se mide cuánto reduce deflate una muestra del inicio del archivo.
+    """
+    if mode == 'store':
+        return zipfile.ZIP_STORED
+    if mode == 'deflate':
+        return zipfile.ZIP_DEFLATED
+
+    with open(path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+
+    if not sample or sample.startswith(COMPRESSED_SIGNATURES):
+        return zipfile.ZIP_STORED
+
+    compressed_size = len(zlib.compress(sample, 1))
+    if compressed_size < len(sample) * (1 - MIN_DEFLATE_SAVING):
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+def file_crc32(path):
+    """(CRC-32, tamaño) de un archivo, leído por bloques"""
+    crc = 0
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    return crc, size
+
+def iter_stored_entry(zipf, buffer, path, info):
+    """
+    Escribir una entrada sin comprimir con el CRC y el tamaño ya en la
+    cabecera local (sin descriptor de datos) y registrarla en `zipf` para
+    el directorio central.
+    """
+    info.CRC, info.file_size = file_crc32(path)
+    info.compress_size = info.file_size
+    info.header_offset = buffer.tell()
+    buffer.write(info.FileHeader())
+
+    crc = 0
+    size = 0
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            buffer.write(chunk)
+            yield buffer.drain()
+
+    if crc != info.CRC or size != info.file_size:
+        raise RuntimeError(f"{info.filename} cambió mientras se añadía al ZIP")
+
+    zipf.filelist.append(info)
+    zipf.NameToInfo[info.filename] = info
+    zipf.start_dir = buffer.tell()
+
+def plan_zip_entries(entries, mode='auto'):
+    """Añadir a cada (ruta, nombre_en_zip) la compresión elegida"""
+    return [(path, arcname, choose_compression(path, mode)) for path, arcname in entries]
+
+def iter_zip_stream(entries):
+    """
+    Generar un ZIP por partes.
+    `entries` es una lista de (ruta, nombre_en_zip, compresión), ver
+    plan_zip_entries. La memoria usada no depende del tamaño de los archivos.
+    """
+    buffer = ZipStreamBuffer()
+
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for path, arcname, compression in entries:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = compression
+
+            if compression == zipfile.ZIP_STORED:
+                for data in iter_stored_entry(zipf, buffer, path, info):
+                    if data:
+                        yield data
+                continue
+
+            file_size = os.path.getsize(path)
+
+            with open(path, 'rb') as source, \
+                    zipf.open(info, 'w', force_zip64=file_size >= zipfile.ZIP64_LIMIT) as dest:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+
+            data = buffer.drain()
+            if data:
+                yield data
+
+    # Directorio central, escrito al cerrar el ZipFile
+    data = buffer.drain()
+    if data:
+        yield data
@@ -134,6 +134,32 @@ def optimize_with_oxipng(image_path):
     except Exception as e:
         return False, f"oxipng no disponible: {str(e)}"
 
+def find_jpeg_quality_for_target(img, target_size, min_quality=70, max_quality=90):
+    """Buscar en memoria (búsqueda binaria) la calidad JPEG más alta bajo el tamaño objetivo"""
+    encoded = {}
+    
+    def encode(quality):
+        if quality not in encoded:
+            buffer = io.BytesIO()
+            img.save(buffer, 'JPEG', quality=quality, optimize=True)
+            encoded[quality] = buffer.getvalue()
+        return encoded[quality]
+    
+    if len(encode(max_quality)) < target_size:
+        return encoded[max_quality], max_quality
+    
+    best_quality = min_quality
+    low, high = min_quality, max_quality - 1
+    while low <= high:
+        quality = (low + high) // 2
+        if len(encode(quality)) < target_size:
+            best_quality = quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    
+    return encode(best_quality), best_quality
+
 def force_size_reduction_safe(image_path, original_dimensions, target_reduction_percent=15):
     """Reducir peso SIN cambiar dimensiones - OPTIMIZADO"""
     try:
@@ -151,10 +177,10 @@ def force_size_reduction_safe(image_path, original_dimensions, target_reduction_
             if img.mode in ('RGBA', 'LA'):
                 if img.mode == 'RGBA':
                     try:
-                        alpha = img.getchannel('A')
-                        alpha_data = list(alpha.getdata())
-                        transparent_pixels = sum(1 for a in alpha_data if a < 255)
-                        total_pixels = len(alpha_data)
+                        # Histograma del canal alfa: una pasada en C, sin lista de píxeles
+                        histogram = img.getchannel('A').histogram()
+                        total_pixels = img.width * img.height
+                        transparent_pixels = total_pixels - histogram[255]
                         transparency_ratio = transparent_pixels / total_pixels if total_pixels > 0 else 0
                         
                         has_real_transparency = transparency_ratio > 0.01
@@ -196,29 +222,14 @@ def force_size_reduction_safe(image_path, original_dimensions, target_reduction_
                 if img.mode != 'RGB':
                     img = img.convert('RGB')
                 
-                # Probar con diferentes calidades de JPEG
-                best_size = original_size
-                best_quality = 85
-                
-                for quality in [90, 85, 80, 75]:
-                    temp_jpg = image_path + f'.temp_{quality}.jpg'
-                    img.save(temp_jpg, 'JPEG', quality=quality, optimize=True)
-                    temp_size = os.path.getsize(temp_jpg)
-                    
-                    if temp_size < best_size:
-                        best_size = temp_size
-                        best_quality = quality
-                    
-                    os.remove(temp_jpg)
-                
-                # Guardar con la mejor calidad como PNG
-                temp_final = image_path + '.final.jpg'
-                img.save(temp_final, 'JPEG', quality=best_quality, optimize=True)
+                # Calidad JPEG más alta que cumpla el objetivo, probada en memoria
+                target_size = original_size * (1 - target_reduction_percent / 100)
+                jpeg_data, best_quality = find_jpeg_quality_for_target(img, target_size)
                 
-                with Image.open(temp_final) as optimized:
+                # Guardar con la mejor calidad como PNG (única escritura a disco)
+                with Image.open(io.BytesIO(jpeg_data)) as optimized:
                     optimized.save(image_path, 'PNG', optimize=True, compress_level=9)
                 
-                os.remove(temp_final)
                 print(f"  ✓ Optimizado vía JPEG quality={best_quality}")
         
         # Verificar resultado
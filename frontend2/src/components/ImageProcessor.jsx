@@ -162,8 +162,55 @@ const ImageProcessor = ({ onNavigate }) => {
      }
    };
  
+   const mergeProcessedResult = (file, result) => {
+     if (result && result.success) {
+       return {
+         ...file,
+         state: PROCESSING_STATES.COMPLETED,
+         progress: 100,
+         currentSize: result.final_size || file.originalSize,
+         reductionPercentage: result.size_reduction || 0,
+         operations: result.operations || [],
+         preview: result.preview_url || file.preview
+       };
+     } else if (result && !result.success) {
+       return {
+         ...file,
+         state: PROCESSING_STATES.ERROR,
+         error: result.message
+       };
+     }
+     return file;
+   };
+ 
+   // Escucha los resultados de cada imagen a medida que el backend los termina
+   const listenProcessingEvents = (currentSessionId) => new Promise((resolve) => {
+     if (typeof EventSource === 'undefined') {
+       resolve(null);
+       return;
+     }
+ 
+     const source = new EventSource(`${API_BASE_URL}/process/${currentSessionId}/events?next=1`);
+ 
+     source.addEventListener('result', (event) => {
+       const { result } = JSON.parse(event.data);
+       setProcessingFiles(prev =>
+         prev.map(file => file.id === result.id ? mergeProcessedResult(file, result) : file)
+       );
+     });
+     source.addEventListener('done', () => source.close());
+     source.onopen = () => resolve(source);
+     // Si el stream tarda en abrir, no se retrasa el procesamiento
+     setTimeout(() => resolve(source), 2000);
+     source.onerror = () => {
+       source.close();
+       resolve(null);
+     };
+   });
+ 
    const handleProcessWithSession = async (currentSessionId) => {
      setProcessing(true);
+     const eventSource = await listenProcessingEvents(currentSessionId);
  
      try {
        const response = await fetch(`${API_BASE_URL}/process`, {
@@ -188,27 +235,7 @@ const ImageProcessor = ({ onNavigate }) => {
        const data = await response.json();
        
        setProcessingFiles(prev => 
-         prev.map(file => {
-           const result = data.results.find(r => r.id === file.id);
-           if (result && result.success) {
-             return {
-               ...file,
-               state: PROCESSING_STATES.COMPLETED,
-               progress: 100,
-               currentSize: result.final_size || file.originalSize,
-               reductionPercentage: result.size_reduction || 0,
-               operations: result.operations || [],
-               preview: result.preview_url || file.preview
-             };
-           } else if (result && !result.success) {
-             return {
-               ...file,
-               state: PROCESSING_STATES.ERROR,
-               error: result.message
-             };
-           }
-           return file;
-         })
+         prev.map(file => mergeProcessedResult(file, data.results.find(r => r.id === file.id)))
        );
        
        setProcessedResults(data.results);
@@ -226,6 +253,9 @@ const ImageProcessor = ({ onNavigate }) => {
        );
        
      } finally {
+       if (eventSource) {
+         eventSource.close();
+       }
        setProcessing(false);
        setIsProcessing(false);
      }
@@ -0,0 +1,30 @@
+"""
+Carga del backend para las pruebas de la API con el cliente de Flask.
+
+El backend usa rutas relativas (uploads, cache, sessions.db) y arranca
+hilos en segundo plano, así que se importa una sola vez por proceso dentro
+de una carpeta temporal que comparten todas las pruebas.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+_work_dir = None
+
+def load_backend():
+    """Módulo `app` del backend, con la carpeta de trabajo temporal como directorio actual"""
+    global _work_dir
+    if _work_dir is None:
+        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        _work_dir = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, _work_dir, True)
+        os.chdir(_work_dir)
+        os.environ['PROCESS_WORKERS'] = '1'
+        os.environ['REMBG_PREWARM'] = '0'
+        sys.path.insert(0, os.path.join(project_root, 'backend2', 'Principal'))
+
+    os.chdir(_work_dir)
+    import app as backend
+    return backend
@@ -0,0 +1,96 @@
+import unittest
+import os
+import io
+import struct
+import zipfile
+
+from PIL import Image
+
+from backend_app import load_backend
+
+class DownloadApiTest(unittest.TestCase):
+    """Descarga ZIP del backend: streaming sin archivo intermedio y reanudación por rangos"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.previous_dir = os.getcwd()
+        cls.backend = load_backend()
+        cls.client = cls.backend.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.previous_dir)
+
+    def _processed_session(self):
+        """Sesión con 3 imágenes procesadas"""
+        files = []
+        for i in range(3):
+            buffer = io.BytesIO()
+            Image.effect_noise((200, 150), 60).convert('RGB').save(buffer, 'PNG')
+            buffer.seek(0)
+            files.append((buffer, f'imagen_{i}.png'))
+
+        response = self.client.post('/api/upload', data={'files': files}, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        session_id = response.get_json()['session_id']
+
+        response = self.client.post('/api/process', json={'session_id': session_id})
+        self.assertEqual(response.status_code, 200)
+        return session_id
+
+    def _download_files(self, session_id):
+        folder = os.path.join(self.backend.UPLOAD_FOLDER, session_id)
+        return [name for name in os.listdir(folder) if name.startswith('.download-')]
+
+    def test_plain_get_streams_zip(self):
+        session_id = self._processed_session()
+
+        response = self.client.get(f'/api/download/{session_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers.get('Accept-Ranges'), 'bytes')
+        data = response.get_data()
+        response.close()
+
+        self.assertEqual(self._download_files(session_id), [])
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(len(archive.namelist()), 3)
+
+    def test_range_request_resumes_same_bytes(self):
+        session_id = self._processed_session()
+
+        response = self.client.get(f'/api/download/{session_id}')
+        full = response.get_data()
+        etag = response.headers['ETag']
+        response.close()
+
+        offset = len(full) // 2
+        response = self.client.get(f'/api/download/{session_id}',
+                                   headers={'Range': f'bytes={offset}-', 'If-Range': etag})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.get_data(), full[offset:])
+        self.assertEqual(response.headers['Content-Range'], f'bytes {offset}-{len(full) - 1}/{len(full)}')
+        response.close()
+
+    def test_stored_entries_carry_sizes_in_local_header(self):
+        session_id = self._processed_session()
+
+        response = self.client.get(f'/api/download/{session_id}?compression=store')
+        data = response.get_data()
+        response.close()
+
+        # Los lectores en streaming solo ven la cabecera local de cada entrada
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for info in archive.infolist():
+                self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                self.assertFalse(info.flag_bits & 0x08)
+                header = data[info.header_offset:info.header_offset + 30]
+                signature, _, flags, _, _, _, crc, compress_size, file_size, _, _ = \
+                    struct.unpack('<IHHHHHIIIHH', header)
+                self.assertEqual(signature, 0x04034b50)
+                self.assertFalse(flags & 0x08)
+                self.assertEqual((crc, compress_size, file_size), (info.CRC, info.file_size, info.file_size))
+
+if __name__ == '__main__':
+    unittest.main()
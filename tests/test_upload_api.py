@@ -0,0 +1,132 @@
+import unittest
+import os
+import io
+import hashlib
+import zipfile
+from unittest import mock
+
+from PIL import Image
+
+from backend_app import load_backend
+
+class UploadApiTest(unittest.TestCase):
+    """Subida multipart en streaming: archivos guardados, rechazados y cuerpos no válidos"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.previous_dir = os.getcwd()
+        cls.backend = load_backend()
+        cls.client = cls.backend.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.previous_dir)
+
+    def _png_bytes(self):
+        buffer = io.BytesIO()
+        Image.effect_noise((120, 90), 60).convert('RGB').save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    def _jpeg_bytes(self):
+        buffer = io.BytesIO()
+        Image.effect_noise((120, 90), 60).convert('RGB').save(buffer, 'JPEG')
+        return buffer.getvalue()
+
+    def _session_folders(self):
+        folder = self.backend.UPLOAD_FOLDER
+        return {name for name in os.listdir(folder)
+                if not name.startswith('.') and os.path.isdir(os.path.join(folder, name))}
+
+    def _upload(self, files):
+        return self.client.post('/api/upload', data={'files': [(io.BytesIO(data), name) for name, data in files]},
+                                content_type='multipart/form-data')
+
+    def test_files_are_written_with_their_hash(self):
+        data = self._png_bytes()
+
+        response = self._upload([('foto.png', data)])
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual(body['uploaded_files'], 1)
+
+        uploaded = body['files'][0]
+        self.assertEqual(uploaded['original_name'], 'foto.png')
+        self.assertEqual(uploaded['size'], len(data))
+        self.assertEqual(uploaded['sha256'], hashlib.sha256(data).hexdigest())
+        with open(uploaded['path'], 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_disallowed_extension_is_rejected(self):
+        before = self._session_folders()
+
+        response = self._upload([('programa.exe', b'MZ' + b'\0' * 64)])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Archivo no permitido: programa.exe', response.get_json()['errors'])
+        self.assertEqual(self._session_folders(), before)
+
+    def test_mismatched_signature_is_discarded(self):
+        response = self._upload([('falsa.png', self._jpeg_bytes()), ('buena.png', self._png_bytes())])
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+
+        self.assertEqual([f['original_name'] for f in body['files']], ['buena.png'])
+        self.assertIn('El contenido no corresponde al formato: falsa.png', body['errors'])
+        session_folder = os.path.join(self.backend.UPLOAD_FOLDER, body['session_id'])
+        self.assertEqual(len(os.listdir(session_folder)), 1)
+
+    def test_truncated_body_returns_400(self):
+        before = self._session_folders()
+        body = (b'--limite\r\n'
+                b'Content-Disposition: form-data; name="files"; filename="cortada.png"\r\n'
+                b'Content-Type: image/png\r\n\r\n' + self._png_bytes()[:200])
+
+        response = self.client.post('/api/upload', data=body, content_type='multipart/form-data; boundary=limite')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Cuerpo de la subida no válido', response.get_json()['error'])
+        self.assertEqual(self._session_folders(), before)
+
+    def test_oversized_body_returns_413(self):
+        before = self._session_folders()
+        app = self.backend.app
+        previous_limit = app.config['MAX_CONTENT_LENGTH']
+        app.config['MAX_CONTENT_LENGTH'] = 64 * 1024
+        try:
+            response = self._upload([('grande.png', b'\x89PNG\r\n\x1a\n' + os.urandom(128 * 1024))])
+        finally:
+            app.config['MAX_CONTENT_LENGTH'] = previous_limit
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self._session_folders(), before)
+
+    def test_declared_length_over_limit_does_not_evict(self):
+        response = self._upload([('procesada.png', self._png_bytes())])
+        session_id = response.get_json()['session_id']
+        self.assertEqual(self.client.post('/api/process', json={'session_id': session_id}).status_code, 200)
+        session_folder = os.path.join(self.backend.UPLOAD_FOLDER, session_id)
+        evicted = self.backend.storage_governor.evicted
+
+        # Cuerpo pequeño con un Content-Length enorme: se rechaza sin liberar espacio
+        response = self.client.post('/api/upload', data=b'--limite--\r\n',
+                                    content_type='multipart/form-data; boundary=limite',
+                                    environ_overrides={'CONTENT_LENGTH': str(10 ** 13)})
+        self.assertEqual(response.status_code, 413)
+        self.assertTrue(os.path.isdir(session_folder))
+        self.assertEqual(self.backend.storage_governor.evicted, evicted)
+
+    def test_zip_expansion_is_reserved_before_extracting(self):
+        before = self._session_folders()
+        images = [self._png_bytes(), self._png_bytes()]
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for i, data in enumerate(images):
+                zipf.writestr(f'imagen_{i}.png', data)
+
+        with mock.patch.object(self.backend.storage_governor, 'ensure_space', side_effect=[None, 'full']) as ensure_space:
+            response = self._upload([('imagenes.zip', archive.getvalue())])
+
+        self.assertEqual(response.status_code, 507)
+        self.assertEqual(ensure_space.call_args_list[1], mock.call(sum(len(data) for data in images)))
+        self.assertEqual(self._session_folders(), before)
+
+if __name__ == '__main__':
+    unittest.main()